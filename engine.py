@@ -0,0 +1,1332 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import time
+from datetime import datetime
+import argparse
+import os
+from pathlib import Path
+import statistics
+import math
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import cv2
+
+from sessions import CPU_BACKEND, DEFAULT_PROVIDERS, MODEL_CACHE_DIR, EXECUTION_MODES, OPT_LEVELS
+from sessions import create_session, find_infected_index, model_hash, input_format
+from results_io import RESULTS_FILENAME, RESULTS_STORE_EXT, SCORE_ENCODINGS, save_results, checkpoint_path, model_results_path
+from results_io import is_results_store, Checkpoint
+from result_cache import ResultCache, RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB, NO_SAMPLE
+from masking import MASKING_BACKENDS, TEXTURE_STEP, resolve_backend, get_process, texture_step
+from manifest import update_manifest
+from profiling import JSONL_EXT, TRACE_EXT, Profiler, span
+from memory_budget import MemoryBudget
+
+# NOTE: onnxruntime and the native leaf masking module are imported only when an analysis is run,
+# so this module can be imported (and the CLI help shown) without them.
+
+
+# Useful colored strings
+hwarning = "\033[93m[WARNING]\033[0m: "
+herror = "\033[91m[ERROR]\033[0m: "
+
+N_SAMPLES_X_TRAY = 351
+
+MASKING_RL_TH = 0.2         # Relative threshold used for leaf masking algorithm
+FOCUS_TH = 0.7              # Minimum mask coverage ratio of a sub-image to be analyzed
+MASK_SCALE = 1.0            # Scale of the image copy the leaf mask is computed on (1 = full resolution)
+
+SUBIMAGE_HEIGHT = 224
+SUBIMAGE_WIDTH = 224
+SUBIMAGE_STRIDE = 224       # px between consecutive sub-images (< SUBIMAGE_WIDTH = overlapping sub-images, denser score maps)
+
+BATCH_SIZE = 32             # Sub-images per inference run (0 = all in-focus sub-images of a sample at once)
+DECODE_WORKERS = 2          # Threads decoding and masking samples while inference runs (0 = sequential)
+PREFETCH_SAMPLES = 4        # Max. samples being prepared or waiting for inference (caps memory)
+STOP_POLL_TIME = 0.5        # s, max. time to react to a cancellation when using worker processes
+WATCH_POLL_TIME = 2.0       # s, time between scans of the experiment folder in watch mode
+WATCH_SETTLE_TIME = 3.0     # s, time an image must stay unmodified before it is analyzed in watch mode
+ETC_WINDOW = 50             # Last samples the estimated time to completion is computed from
+
+
+def get_expdata(expdir, tray_slots=N_SAMPLES_X_TRAY):
+    """
+        Reads the manifest of an experiment folder (<date>/<tray>/<NNN-ID>.png, see manifest.py) and
+        returns its description dict, or None if the folder does not have any timepoint sub-folder.
+        Each tray has max(tray_slots, highest sample number) sample slots (0 = highest sample number).
+    """
+    n_images = 0
+    img_files = {}
+    results = {}
+
+    expdir = Path(expdir)
+
+    manifest = update_manifest(expdir)
+
+    if len(manifest) == 0:
+        print(herror+"Experiment folder does not have any timepoint sub-folder!")
+        return None
+
+    date_list = []
+    for d in manifest:
+        date_str = d.split("_")[0]
+        date_list.append(datetime.strptime(date_str, '%m-%d-%Y'))
+
+    datefolders = [d for _, d in sorted(zip(date_list, manifest), key=lambda x: x[0])]
+
+    for d in datefolders:
+        img_files[d] = {}
+        results[d] = {}
+
+        for t, images in manifest[d].items():
+            # NOTE: Sample numbers start at 1, images numbered 0 or less are skipped
+            images = [img for img in images if img[0] > 0]
+            n_slots = max([tray_slots] + [img[0] for img in images])
+            img_files[d][t] = [None]*n_slots
+            results[d][t] = [None]*n_slots
+
+            for nsample, filename, _, _ in images:
+                if img_files[d][t][nsample-1] is None:
+                    n_images += 1
+                img_files[d][t][nsample-1] = filename
+
+    exp_data = {}
+    exp_data["name"] = expdir.parts[-1]
+    exp_data["path"] = expdir
+    exp_data["nimages"] = n_images
+    exp_data["samples"] = img_files
+    exp_data["results"] = results # This might be useless
+    return exp_data
+
+
+def read_file(img_path):
+    """
+        NOTE: This function is implemented to read images from an UTF-8 path string
+        The file is read straight into the NumPy array (no intermediate bytes copies)
+    """
+    return np.fromfile(img_path, dtype=np.uint8)
+
+
+def read_image(img_path):
+    return cv2.imdecode(read_file(img_path), cv2.IMREAD_UNCHANGED) # Returns BGR image
+
+
+def focus_grid(imask, xi, yi, n_xsteps, n_ysteps):
+    """
+        Returns a (n_ysteps, n_xsteps) boolean grid with the sub-images whose mask coverage
+        ratio is above FOCUS_TH. All ratios are computed in a single pass over the mask.
+    """
+    crop = imask[yi:yi+(n_ysteps*SUBIMAGE_HEIGHT), xi:xi+(n_xsteps*SUBIMAGE_WIDTH)]
+    blocks = crop.reshape(n_ysteps, SUBIMAGE_HEIGHT, n_xsteps, SUBIMAGE_WIDTH) # View, no copy
+    mask_ratio = blocks.sum(axis=(1,3), dtype=np.uint32) / (SUBIMAGE_HEIGHT*SUBIMAGE_WIDTH) / 255
+    return mask_ratio > FOCUS_TH
+
+
+def focus_grid_scaled(imask, im_w, im_h, xi, yi, n_xsteps, n_ysteps):
+    """
+        Same as focus_grid(), from the mask of a downscaled copy of the (im_w, im_h) image. Sub-image
+        bounds are mapped to the nearest mask pixel and coverage ratios come from its integral image.
+    """
+    y_edges = np.rint((yi + SUBIMAGE_HEIGHT*np.arange(n_ysteps+1)) * imask.shape[0] / im_h).astype(int)
+    x_edges = np.rint((xi + SUBIMAGE_WIDTH*np.arange(n_xsteps+1)) * imask.shape[1] / im_w).astype(int)
+    integral = cv2.integral(imask, sdepth=cv2.CV_64F)
+    top, bottom = integral[y_edges[:-1]], integral[y_edges[1:]]
+    mask_sum = bottom[:, x_edges[1:]] - bottom[:, x_edges[:-1]] - top[:, x_edges[1:]] + top[:, x_edges[:-1]]
+    area = np.outer(np.diff(y_edges), np.diff(x_edges))
+    mask_ratio = mask_sum / np.maximum(area, 1) / 255
+    return mask_ratio > FOCUS_TH
+
+
+def focus_grid_strided(imask, im_w, im_h, xi, yi, n_xsteps, n_ysteps, stride):
+    """
+        Same as focus_grid(), for overlapping sub-images every 'stride' px (a divisor of SUBIMAGE_WIDTH)
+        over the same crop. Returns a ((n_ysteps-1)*f+1, (n_xsteps-1)*f+1) grid, f = SUBIMAGE_WIDTH/stride,
+        whose every f-th row and column is focus_grid(). The mask can be of a downscaled copy of the
+        (im_w, im_h) image, coverage ratios come from its integral image as in focus_grid_scaled().
+    """
+    f = SUBIMAGE_WIDTH // stride
+    y0 = yi + stride*np.arange(max((n_ysteps-1)*f + 1, 0))
+    x0 = xi + stride*np.arange(max((n_xsteps-1)*f + 1, 0))
+    y_start, y_end = (np.rint(y * imask.shape[0] / im_h).astype(int) for y in (y0, y0 + SUBIMAGE_HEIGHT))
+    x_start, x_end = (np.rint(x * imask.shape[1] / im_w).astype(int) for x in (x0, x0 + SUBIMAGE_WIDTH))
+    integral = cv2.integral(imask, sdepth=cv2.CV_64F)
+    mask_sum = integral[np.ix_(y_end, x_end)] - integral[np.ix_(y_end, x_start)] \
+               - integral[np.ix_(y_start, x_end)] + integral[np.ix_(y_start, x_start)]
+    area = np.outer(y_end - y_start, x_end - x_start)
+    mask_ratio = mask_sum / np.maximum(area, 1) / 255
+    return mask_ratio > FOCUS_TH
+
+
+def tile_view(img, xi, yi, n_xsteps, n_ysteps, stride=SUBIMAGE_WIDTH):
+    """
+        Returns the centred crop of the image as a (n_ysteps, n_xsteps, H, W, C) strided view
+        of its sub-images (no data is copied). With a stride below SUBIMAGE_WIDTH the sub-images
+        overlap, and n_xsteps, n_ysteps are the number of sub-images (see focus_grid_strided()).
+    """
+    if stride != SUBIMAGE_WIDTH:
+        crop = img[yi:, xi:]
+        return np.lib.stride_tricks.as_strided(crop,
+                                               (n_ysteps, n_xsteps, SUBIMAGE_HEIGHT, SUBIMAGE_WIDTH, crop.shape[2]),
+                                               (crop.strides[0]*stride, crop.strides[1]*stride) + crop.strides,
+                                               writeable=False)
+    crop = img[yi:yi+(n_ysteps*SUBIMAGE_HEIGHT), xi:xi+(n_xsteps*SUBIMAGE_WIDTH)]
+    return crop.reshape(n_ysteps, SUBIMAGE_HEIGHT, n_xsteps, SUBIMAGE_WIDTH, -1).swapaxes(1, 2)
+
+
+def aggregate_scores(score_map, stride):
+    """
+        Aggregates a score map of overlapping sub-images (see focus_grid_strided()) back to the
+        SUBIMAGE_WIDTH grid: each sub-image gets the mean score of the overlapping ones, weighted
+        by their overlap area. Sub-images not in focus on the SUBIMAGE_WIDTH grid stay NaN.
+    """
+    f = SUBIMAGE_WIDTH // stride
+    w = 1 - np.abs(np.arange(1-f, f)) / f # Overlap of the sub-images 0, 1, ... f-1 strides away
+    kernel = np.outer(w, w).astype(np.float32)
+    valid = ~np.isnan(score_map)
+    weighted = cv2.filter2D(np.where(valid, score_map, 0).astype(np.float32), -1, kernel, borderType=cv2.BORDER_CONSTANT)
+    weights = cv2.filter2D(valid.astype(np.float32), -1, kernel, borderType=cv2.BORDER_CONSTANT)
+    aggregated = weighted[::f, ::f] / np.maximum(weights[::f, ::f], 1e-6)
+    aggregated[~valid[::f, ::f]] = np.nan
+    return aggregated
+
+
+def get_batch_buffer(batch_buffer, n):
+    # NCHW float32 buffer (held in a mutable list) reused across batches and samples, only grows when needed
+    if batch_buffer[0] is None or batch_buffer[0].shape[0] < n:
+        batch_buffer[0] = np.empty((n, 3, SUBIMAGE_HEIGHT, SUBIMAGE_WIDTH), dtype=np.float32)
+    return batch_buffer[0][:n]
+
+
+def format_etc(seconds):
+    tsec = int(seconds % 60)
+    tmin = math.floor(seconds / 60) % 60
+    thour = math.floor(seconds / 3600)
+    return '{:02d}'.format(thour) + ':' + '{:02d}'.format(tmin) + ':' + '{:02d}'.format(tsec)
+
+
+def analysis_params(model_path, mask_opts=None):
+    # Model and analysis parameters a score map depends on (result cache key and checkpoint header)
+    mask_opts = mask_opts if mask_opts is not None else {}
+    params = {"model": model_hash(model_path),
+              "masking": resolve_backend(mask_opts.get("backend", "auto")),
+              "mask_scale": mask_opts.get("scale", MASK_SCALE),
+              "masking_rl_th": MASKING_RL_TH,
+              "focus_th": FOCUS_TH,
+              "subimage": f"{SUBIMAGE_HEIGHT}x{SUBIMAGE_WIDTH}"}
+    if mask_opts.get("stride", SUBIMAGE_STRIDE) != SUBIMAGE_WIDTH:
+        params["stride"] = mask_opts["stride"]
+        params["aggregate"] = bool(mask_opts.get("aggregate", False))
+    return params
+
+
+def open_result_cache(model_path, cache_opts, mask_opts=None):
+    # Score maps cache (see result_cache.py) for this model and analysis parameters, None if disabled
+    if cache_opts is None or cache_opts.get("cache_dir") is None:
+        return None
+    key_params = analysis_params(model_path, mask_opts)
+    return ResultCache(cache_opts["cache_dir"], key_params, cache_opts.get("max_mb", RESULT_CACHE_MAX_MB))
+
+
+def sample_focus(input_img, mask_opts=None, trace=None):
+    """
+        Leaf masking of the RGB sample image. Returns (focus, xi, yi), where focus is the grid of
+        sub-images to be analyzed (see focus_grid()) and xi, yi the offset of the sub-images crop,
+        or None if no sample is found in the image.
+        mask_opts: "backend" (leaf masking backend, see masking.py), "scale" (the mask is computed
+        on a downscaled copy of the image, ~scale^2 masking cost, rounded to a multiple of 1/TEXTURE_STEP)
+        and "stride" (overlapping sub-images every stride px, the focus grid is then the one of
+        focus_grid_strided()).
+        trace: profiling.SampleTrace the masking and focus test times are recorded to, if given.
+    """
+    mask_opts = mask_opts if mask_opts is not None else {}
+    # NOTE: The scale is rounded to a whole texture grid step (ex: 0.25 -> 2/6), see masking.texture_grid()
+    step = texture_step(mask_opts.get("scale", MASK_SCALE))
+    process = get_process(mask_opts.get("backend", "auto"), step)
+    scale = step / TEXTURE_STEP
+    stride = mask_opts.get("stride", SUBIMAGE_STRIDE)
+
+    im_h, im_w, _ = input_img.shape
+
+    step = 1 # Assume step is always 1:1 resolution (no sub-image overlapping)
+    step = math.floor(SUBIMAGE_WIDTH / step)
+
+    # obtain remaining pixels at the last iteration
+    offsetX = im_w % step
+    offsetY = im_h % step
+
+    n_xsteps =  math.floor(im_w / step)
+    n_ysteps = math.floor(im_h / step)
+
+    xi = int(offsetX / 2)
+    yi = int(offsetY / 2)
+
+    # TODO: Line 353 matlab
+
+    with span(trace, "masking"):
+        if scale < 1:
+            # NOTE: Subsampled, not averaged: averaging lowers the texture (std. deviation) of the background
+            small_img = cv2.resize(input_img, (max(round(im_w*scale), 1), max(round(im_h*scale), 1)), interpolation=cv2.INTER_NEAREST)
+            imask = process(small_img, MASKING_RL_TH)
+        else:
+            imask = process(input_img, MASKING_RL_TH)
+    if imask is None:
+        return None
+
+    with span(trace, "focus"):
+        if stride != SUBIMAGE_WIDTH:
+            return focus_grid_strided(imask, im_w, im_h, xi, yi, n_xsteps, n_ysteps, stride), xi, yi
+        if scale < 1:
+            return focus_grid_scaled(imask, im_w, im_h, xi, yi, n_xsteps, n_ysteps), xi, yi
+        return focus_grid(imask, xi, yi, n_xsteps, n_ysteps), xi, yi
+
+
+def put_no_sample(caches, cache_keys, score_maps, trace=None):
+    # Caches the image as without sample (NO_SAMPLE) for the models it isn't cached as such yet
+    with span(trace, "cache"):
+        for cache, key, score_map in zip(caches, cache_keys, score_maps):
+            if cache is not None and score_map is not NO_SAMPLE:
+                cache.put(key, NO_SAMPLE)
+
+
+def prepare_sample(img_path, caches=None, mask_opts=None, trace=None):
+    """
+        Decoding and masking stage of the analysis of one sample image, shared by all the models.
+        Returns a dict with the RGB image, focus grid, xi, yi, and the cache key and cached score
+        map of each model (one entry per cache in caches), or None if the image could not be
+        loaded or no sample is found in it. If the score maps of all the models are cached, the
+        image is not decoded and only "score_maps" is returned. Images without sample are cached
+        too (NO_SAMPLE), and are not decoded nor masked again.
+        mask_opts are the leaf masking options, see sample_focus(), and "channels": the image is
+        kept in BGR order (as decoded, no colour conversion) if "BGR", see image_channels().
+        trace: profiling.SampleTrace the time of each stage is recorded to, if given.
+    """
+    caches = caches if caches is not None else []
+
+    # NOTE: Decode, RGB and mask buffers are not pooled: cv2.imdecode can't decode into a given
+    # buffer, the RGB conversion is done in place, and pooling the file and mask buffers kept large
+    # blocks resident (higher peak memory, no speed gain). Memory is capped with memory_budget.py.
+    with span(trace, "read"):
+        data = read_file(img_path)
+    with span(trace, "cache"):
+        cache_keys = [cache.key(data) if cache is not None else None for cache in caches]
+        score_maps = [cache.get(key) if cache is not None else None for cache, key in zip(caches, cache_keys)]
+    # NOTE: The leaf masking doesn't depend on the model, a single NO_SAMPLE entry is enough
+    if any(s is NO_SAMPLE for s in score_maps):
+        put_no_sample(caches, cache_keys, score_maps, trace)
+        if trace is not None:
+            trace.note(cached=True)
+        print(hwarning+"No sample found in: '"+str(img_path)+"'!")
+        return None
+    if len(caches) and all(s is not None for s in score_maps):
+        if trace is not None:
+            trace.note(cached=True)
+        return {"score_maps": score_maps}
+
+    with span(trace, "decode"):
+        input_img = cv2.imdecode(data, cv2.IMREAD_UNCHANGED) # Returns BGR image
+    if trace is not None:
+        trace.note(file_mb=data.nbytes / 2**20)
+    del data
+    if input_img is None:
+        print(herror+"Image '"+str(img_path)+"' could not be loaded!")
+        return None
+    mask_opts = mask_opts if mask_opts is not None else {}
+    channels = mask_opts.get("channels", "RGB")
+    bgra = input_img.ndim == 3 and input_img.shape[2] == 4
+    if channels == "RGB":
+        with span(trace, "color"):
+            if input_img.ndim == 3 and input_img.shape[2] == 3:
+                # NOTE: Converted in place, no second full size image
+                cv2.cvtColor(input_img, cv2.COLOR_BGR2RGB, dst=input_img)
+            else:
+                input_img = cv2.cvtColor(input_img, cv2.COLOR_BGRA2RGB if bgra else cv2.COLOR_BGR2RGB)
+    elif bgra:
+        with span(trace, "color"):
+            input_img = cv2.cvtColor(input_img, cv2.COLOR_BGRA2BGR)
+    if trace is not None:
+        trace.note(image_mb=input_img.nbytes / 2**20)
+
+    focus = sample_focus(input_img, mask_opts, trace)
+    if focus is None:
+        put_no_sample(caches, cache_keys, score_maps, trace)
+        print(hwarning+"No sample found in: '"+str(img_path)+"'!")
+        return None
+
+    return {"image": input_img,
+            "focus": focus[0],
+            "xi": focus[1],
+            "yi": focus[2],
+            "stride": mask_opts.get("stride", SUBIMAGE_STRIDE),
+            "aggregate": mask_opts.get("aggregate", False),
+            "channels": channels,
+            "cache_keys": cache_keys,
+            "score_maps": score_maps}
+
+
+def score_sample_models(models, prepared, batch_buffer=None, caches=None, trace=None):
+    """
+        Inference stage of the analysis of one sample image, prepared by prepare_sample().
+        models is a list of (session, infected_prob_idx, batch_size), as returned by load_model().
+        Each sub-image batch is built once and fed to every model not cached yet. Returns the
+        infection score map of the sample for each model (NaN for not-focused sub-images), on the
+        grid of overlapping sub-images if the sample was prepared with a stride (see sample_focus()),
+        unless it is aggregated back to the SUBIMAGE_WIDTH grid (see aggregate_scores()).
+        trace: profiling.SampleTrace the tiling and inference times, tile counts and batch sizes
+        are recorded to, if given.
+    """
+    if prepared is None:
+        return [None] * len(models)
+
+    cached = prepared["score_maps"]
+    score_maps = [cached[k] if k < len(cached) else None for k in range(len(models))]
+    todo = [k for k in range(len(models)) if score_maps[k] is None]
+    if len(todo) == 0:
+        return score_maps
+
+    if batch_buffer is None:
+        batch_buffer = [None]
+
+    input_img, on_focus, xi, yi = prepared["image"], prepared["focus"], prepared["xi"], prepared["yi"]
+    n_ysteps, n_xsteps = on_focus.shape
+
+    # If sub-image is not focused, insert NaN score, and skip
+    for k in todo:
+        score_maps[k] = np.zeros((n_ysteps, n_xsteps), dtype=np.float32)
+        score_maps[k][~on_focus] = np.nan
+    focus_i, focus_j = np.nonzero(on_focus) # Row-major order, same as the sub-image grid
+    stride = prepared.get("stride", SUBIMAGE_STRIDE)
+    tiles = tile_view(input_img, xi, yi, n_xsteps, n_ysteps, stride)
+    if trace is not None:
+        trace.note(tiles=int(on_focus.size), in_focus=len(focus_i))
+
+    # Sub-images in the channel order of the image and in the other one (views), and input format of each model
+    channels = prepared.get("channels", "RGB")
+    views = {channels: tiles, ("BGR" if channels == "RGB" else "RGB"): tiles[..., ::-1]}
+    formats = {k: input_format(models[k][0]) for k in todo}
+
+    batch_sizes = [models[k][2] for k in todo if models[k][2] > 0]
+    n_batch = min(batch_sizes) if len(batch_sizes) else max(len(focus_i), 1)
+    for b in range(0, len(focus_i), n_batch):
+        chunk_i = focus_i[b:b+n_batch]
+        chunk_j = focus_j[b:b+n_batch]
+
+        # CNN pre-processing
+        #subimg /= 255. # NOTE: Normalization layer inside the original CNNs!!!!!
+        # Each batch is built once for all the models taking the same input format
+        batches = {}
+        with span(trace, "tiling"):
+            for nhwc, fmt_channels in set(formats.values()):
+                view = views[fmt_channels]
+                if nhwc:
+                    # uint8 NHWC models (see models/onnx_uint8_input.py) take the sub-images without conversion
+                    batches[(nhwc, fmt_channels)] = np.ascontiguousarray(view[chunk_i, chunk_j])
+                    continue
+                batch = get_batch_buffer(batch_buffer, len(chunk_i))
+                for n, (i, j) in enumerate(zip(chunk_i, chunk_j)):
+                    # Single uint8 HWC to float32 CHW (ONNX) conversion, straight into the buffer
+                    np.copyto(batch[n], view[i, j].transpose(2, 0, 1), casting="unsafe")
+                batches[(nhwc, fmt_channels)] = batch
+        if trace is not None:
+            trace.note(batch=len(chunk_i))
+
+        for k in todo:
+            sess, out_pos, _ = models[k]
+            with span(trace, "inference"):
+                preds = sess.run([sess.get_outputs()[0].name], {sess.get_inputs()[0].name: batches[formats[k]]})[0]
+
+            # WARNING: TO BE CONFIRMED FOR EACH CNN -> pred[0] Infected, pred[1] Clear
+            # Use analyzeNetwork() func in MATLAB to check this
+            score_maps[k][chunk_i, chunk_j] = preds[:, out_pos]
+
+    if stride != SUBIMAGE_WIDTH and prepared.get("aggregate", False):
+        for k in todo:
+            score_maps[k] = aggregate_scores(score_maps[k], stride)
+
+    if caches is not None:
+        with span(trace, "cache"):
+            for k in todo:
+                if caches[k] is not None and prepared["cache_keys"][k] is not None:
+                    caches[k].put(prepared["cache_keys"][k], score_maps[k])
+
+    return score_maps
+
+
+def score_sample(sess, prepared, out_pos, batch_size=BATCH_SIZE, batch_buffer=None, cache=None):
+    """
+        Inference stage of the analysis of one sample image, prepared by prepare_sample().
+        Returns the infection score map of the sample (NaN for not-focused sub-images).
+    """
+    return score_sample_models([(sess, out_pos, batch_size)], prepared, batch_buffer, [cache])[0]
+
+
+def compute_sample(sess, img_path, out_pos, batch_size=BATCH_SIZE, batch_buffer=None, cache=None):
+    """
+        Returns the infection score map of the sample image (NaN for not-focused sub-images),
+        or None if the image could not be loaded or no sample is found in it.
+    """
+    return score_sample(sess, prepare_sample(img_path, [cache]), out_pos, batch_size, batch_buffer, cache)
+
+
+def iter_samples(expdata):
+    # Yields (date, tray, sample_idx, image_filename) of every image in the experiment, in analysis order
+    for date in expdata["samples"]:
+        for tray in expdata["samples"][date]:
+            for sample in expdata["samples"][date][tray]:
+                if sample is None:
+                    continue
+                yield date, tray, int(sample.split('-')[0]) - 1, sample
+
+
+def empty_results(expdata):
+    # Results dict with the same dates, trays and sample slots as the experiment, and no results
+    return {d: {t: [None]*len(expdata["samples"][d][t]) for t in expdata["samples"][d]} for d in expdata["samples"]}
+
+
+def prefetch_samples(expdir, items, workers, prefetch, caches=None, mask_opts=None, profiler=None, memory_mb=0):
+    """
+        Runs prepare_sample() on a pool of worker threads, ahead of the inference stage.
+        Yields (item, prepared) in the same order as items, with at most 'prefetch' samples
+        being prepared or waiting to be consumed at any time (bounds the memory used).
+        With memory_mb, the memory of those samples is also capped to memory_mb (see
+        memory_budget.MemoryBudget): samples wait for budget before their file is read.
+        With 0 workers, samples are prepared sequentially when requested.
+        Stage times are recorded to profiler (profiling.Profiler), if given.
+    """
+    def trace(item):
+        return profiler.sample(item[:3]) if profiler is not None else None
+
+    if workers <= 0:
+        for item in items:
+            yield item, prepare_sample(expdir / item[0] / item[1] / item[3], caches, mask_opts, trace(item))
+        return
+
+    budget = MemoryBudget(memory_mb * 2**20) if memory_mb > 0 else None
+
+    def prepare(item, ticket):
+        # Returns the prepared sample and the bytes it keeps reserved until it is scored
+        img_path = expdir / item[0] / item[1] / item[3]
+        if budget is None:
+            return prepare_sample(img_path, caches, mask_opts, trace(item)), 0
+        try:
+            reserved = budget.estimate(os.path.getsize(img_path))
+        except OSError: # Reported by prepare_sample()
+            reserved = 0
+        if not budget.reserve(ticket, reserved):
+            return None, 0
+        try:
+            prepared = prepare_sample(img_path, caches, mask_opts, trace(item))
+        except BaseException:
+            budget.release(reserved)
+            raise
+        kept = prepared["image"].nbytes if prepared is not None and "image" in prepared else 0
+        if kept > 0:
+            budget.seen_image(kept)
+        budget.release(reserved - kept)
+        return prepared, kept
+
+    pending = deque()
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                while len(pending) < max(prefetch, 1):
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    pending.append((item, pool.submit(prepare, item, budget.ticket() if budget is not None else None)))
+
+                if len(pending) == 0:
+                    return
+
+                item, future = pending.popleft()
+                prepared, kept = future.result()
+                yield item, prepared
+                if budget is not None:
+                    budget.release(kept)
+        finally:
+            # Consumer stopped early (ex: analysis cancelled), drop queued work
+            if budget is not None:
+                budget.close()
+            for _, future in pending:
+                future.cancel()
+
+
+def load_model(model_path, providers=None, threads=0, batch_size=BATCH_SIZE, session_opts=None):
+    """
+        Creates the inference session of the model and resolves its infected score index.
+        session_opts are extra sessions.create_session() arguments (inter_threads, execution_mode,
+        opt_level, cache_dir). Returns (session, infected_prob_idx, batch_size), where batch_size
+        is limited to the model batch dimension if it is fixed.
+    """
+    session_opts = session_opts if session_opts is not None else {}
+    ort_sess = create_session(model_path, providers, threads, **session_opts)
+    infected_prob_idx = find_infected_index(ort_sess, model_path, session_opts.get("cache_dir", MODEL_CACHE_DIR))
+
+    # Models exported with a fixed batch dimension can only take one sub-image per run
+    in_batch_dim = ort_sess.get_inputs()[0].shape[0]
+    if isinstance(in_batch_dim, int) and in_batch_dim > 0 and batch_size != in_batch_dim:
+        print(hwarning+f"Model has a fixed batch size of {in_batch_dim}, batched inference disabled. "
+              "Use models/onnx_dynamic_batch.py to export it with a dynamic batch axis.")
+        batch_size = in_batch_dim
+
+    return ort_sess, infected_prob_idx, batch_size
+
+
+def image_channels(models):
+    """
+        Channel order the sample images are kept in for the loaded models: "BGR" (as decoded, the
+        colour conversion is skipped) if all of them take BGR uint8 sub-images, else "RGB".
+        NOTE: Leaf masking does not depend on the channel order.
+    """
+    return "BGR" if all(input_format(m[0]) == (True, "BGR") for m in models) else "RGB"
+
+
+def analyze_samples(expdir, items, model_paths, providers, threads, session_opts, cache_opts, mask_opts, batch_size,
+                    workers, prefetch, stop, profiler=None, memory_mb=0):
+    # Analyzes the samples in this process, yields (item, [score_map of each model]) in the same order as items
+    models = [load_model(p, providers, threads, batch_size, session_opts) for p in model_paths]
+    caches = [open_result_cache(p, cache_opts, mask_opts) for p in model_paths]
+    mask_opts = dict(mask_opts, channels=image_channels(models))
+    yield from score_items(expdir, items, models, caches, mask_opts, [None], workers, prefetch, stop, profiler, memory_mb)
+
+
+def score_items(expdir, items, models, caches, mask_opts, batch_buffer, workers, prefetch, stop, profiler=None, memory_mb=0):
+    # Scores the samples with already loaded models, yields (item, [score_map of each model]) in items order
+    samples = prefetch_samples(expdir, items, workers, prefetch, caches, mask_opts, profiler, memory_mb)
+    for item, prepared in samples:
+        if stop is not None and stop.is_set():
+            samples.close()
+            return
+        trace = profiler.sample(item[:3]) if profiler is not None else None
+        score_maps = score_sample_models(models, prepared, batch_buffer, caches, trace)
+        if trace is not None:
+            trace.note_memory()
+        yield item, score_maps
+
+
+# Per-process state of the analysis worker processes
+_worker = {}
+
+def _init_worker(model_paths, providers, threads, session_opts, cache_opts, mask_opts, batch_size, profile=False):
+    _worker["models"] = [load_model(p, providers, threads, batch_size, session_opts) for p in model_paths]
+    _worker["caches"] = [open_result_cache(p, cache_opts, mask_opts) for p in model_paths]
+    _worker["mask_opts"] = dict(mask_opts, channels=image_channels(_worker["models"]))
+    _worker["batch_buffer"] = [None]
+    _worker["profile"] = profile
+
+def _worker_compute_sample(img_path, key):
+    # Returns the score maps of the sample, and the stage timings recorded (see Profiler.export()) if profiling
+    profiler = Profiler() if _worker["profile"] else None
+    trace = profiler.sample(key) if profiler is not None else None
+    prepared = prepare_sample(img_path, _worker["caches"], _worker["mask_opts"], trace)
+    score_maps = score_sample_models(_worker["models"], prepared, _worker["batch_buffer"], _worker["caches"], trace)
+    if trace is not None:
+        trace.note_memory()
+    return score_maps, profiler.export() if profiler is not None else None
+
+
+def analyze_samples_mp(expdir, items, model_paths, providers, threads, session_opts, cache_opts, mask_opts, batch_size,
+                       processes, stop, profiler=None):
+    """
+        Analyzes the samples on a pool of worker processes, each one with its own inference sessions.
+        Yields (item, [score_map of each model]) as samples are completed (not in items order).
+        Stage timings recorded by the workers are merged into profiler, if given.
+    """
+    if threads <= 0: # Share the CPU cores between the worker sessions
+        threads = max(1, (os.cpu_count() or 1) // processes)
+
+    # NOTE: "spawn" is the only start method in Windows, used everywhere so behaviour is the same
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=ctx,
+                             initializer=_init_worker,
+                             initargs=(model_paths, providers, threads, session_opts, cache_opts, mask_opts, batch_size,
+                                       profiler is not None)) as pool:
+        pending = {pool.submit(_worker_compute_sample, expdir / item[0] / item[1] / item[3], item[:3]): item for item in items}
+        try:
+            while len(pending):
+                done, _ = wait(pending, timeout=STOP_POLL_TIME, return_when=FIRST_COMPLETED)
+                if stop is not None and stop.is_set():
+                    return
+                for future in done:
+                    score_maps, timings = future.result()
+                    if timings is not None:
+                        profiler.merge(timings)
+                    yield pending.pop(future), score_maps
+        finally:
+            # Samples not started yet are dropped, running ones are let finish
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def analyze_items(expdata, analyzed, ckpts, results, samples_done, progress, profiler=None):
+    """
+        Stores the analyzed (item, [score_map of each model]) results in the checkpoint of each model,
+        or in its results dict if not checkpointing. The time to completion passed to progress is
+        estimated from the last ETC_WINDOW samples (first samples are slower: model warm-up, empty
+        prefetch queue, cold file cache).
+    """
+    total_images = expdata["nimages"]
+    sample_times = deque(maxlen=ETC_WINDOW)
+
+    t_start = time.time()
+    for (date, tray, sample_idx, sample), score_maps in analyzed:
+        trace = profiler.sample((date, tray, sample_idx)) if profiler is not None else None
+        sample_id = os.path.splitext(sample)[0]
+        with span(trace, "persist"):
+            for k, score_map in enumerate(score_maps):
+                if ckpts is not None:
+                    if not ckpts[k].is_done(date, tray, sample_idx):
+                        ckpts[k].append(date, tray, sample_idx, sample_id, score_map)
+                else:
+                    # Store result tuple of (sample_id_str, score_map)
+                    results[k][date][tray][sample_idx] = (sample_id, score_map)
+
+        # Time between consecutive samples (decoding overlaps with inference)
+        t_end = time.time()
+        sample_times.append(t_end-t_start)
+        if trace is not None:
+            trace.note(date=date, tray=tray, sample_idx=sample_idx, image=sample, wall_s=t_end-t_start)
+        t_start = t_end
+
+        samples_done += 1
+
+        if progress is not None:
+            etc = statistics.mean(sample_times) * (total_images-samples_done)
+            progress(samples_done, total_images, etc)
+
+
+def analyze_experiment(expdir,
+                       model_path,
+                       providers=None,
+                       threads=0,
+                       session_opts=None,
+                       result_cache_dir=None,
+                       result_cache_mb=RESULT_CACHE_MAX_MB,
+                       masking="auto",
+                       mask_scale=MASK_SCALE,
+                       stride=SUBIMAGE_STRIDE,
+                       aggregate=False,
+                       batch_size=BATCH_SIZE,
+                       workers=DECODE_WORKERS,
+                       prefetch=PREFETCH_SAMPLES,
+                       memory_mb=0,
+                       processes=1,
+                       out_path=None,
+                       results_opts=None,
+                       checkpoint=False,
+                       progress=None,
+                       stop=None,
+                       expdata=None,
+                       tray_slots=N_SAMPLES_X_TRAY,
+                       profiler=None
+):
+    """
+        Runs the CNN analysis over all the samples of an experiment folder.
+            - model_path: path of the ONNX model, or list of paths to analyze the experiment with
+              several models at once (images are decoded, masked and split in sub-images only once)
+            - providers: ONNX Runtime execution providers, in order of preference (default: DirectML,
+              CPU as fallback)
+            - threads: intra-op threads of the inference session (0 = ONNX Runtime default, or the
+              CPU cores split between processes)
+            - session_opts: other session options, see sessions.create_session()
+            - result_cache_dir: if given, score maps are cached there (see result_cache.py) keyed on the
+              image contents, model and analysis parameters, and cached images are not analyzed again.
+              The cache is limited to result_cache_mb (least recently used entries are evicted).
+            - masking: leaf masking backend, "native" (compiled module, Windows and Python 3.11 only),
+              "numpy" or "auto" (native if available)
+            - mask_scale: if < 1, the leaf mask is computed on a copy of each image downscaled by this
+              factor (rounded to a multiple of 1/6, the texture grid step), and the sub-images coverage is
+              derived from the small mask (see test/check_mask_scale.py to validate the sub-images selected
+              against the full resolution mask)
+            - stride: px between consecutive sub-images, a divisor of SUBIMAGE_WIDTH. Below it sub-images
+              overlap and score maps have (SUBIMAGE_WIDTH/stride)^2 times more scores (and inference runs)
+            - aggregate: with a stride, aggregate the scores back to the SUBIMAGE_WIDTH grid (mean of the
+              overlapping sub-images, see aggregate_scores()), so results have the usual shape
+            - workers, prefetch: decoding/masking threads and max. samples prepared ahead of inference
+            - memory_mb: if > 0, memory cap (MB) of the samples being read, decoded and masked or
+              waiting for inference (see memory_budget.MemoryBudget). Worker processes analyze one
+              sample at a time, so it only applies to the analysis in this process
+            - processes: number of worker processes the samples are distributed to (1 = this process)
+            - out_path: if given, results are saved there when the analysis completes. With several
+              models, the results of each one go to a separate file (see results_io.model_results_path())
+            - results_opts: score map encoding of the results files, results_io.save_results() "encoding"
+              and "compress" arguments (default: float32 arrays)
+            - checkpoint: if True (requires out_path), each score map is appended to a checkpoint file
+              next to out_path as soon as it is computed instead of being kept in memory. Samples
+              already in the checkpoint (ex: from a stopped run) are not analyzed again, and the
+              results file is built from the checkpoint at the end.
+            - progress: callback(samples_done, total_images, etc_seconds) called after each sample
+            - stop: threading.Event, the analysis is cancelled when it is set
+            - expdata: already loaded experiment data (see get_expdata()) to avoid scanning it again
+            - tray_slots: min. number of sample slots of each tray when scanning the experiment
+            - profiler: profiling.Profiler the time of each stage of every sample, tile counts and
+              batch sizes are recorded to (see Profiler.save() and Profiler.print_summary())
+
+        Returns the results dict ({date: {tray: [(sample_id, score_map), ...]}}), or an empty dict
+        if the analysis is cancelled. Results do not depend on the number of processes/workers.
+        With checkpoint, the path of the results file is returned instead of the results dict.
+        With a list of models, a list with the results (or path) of each model is returned.
+    """
+    single_model = isinstance(model_path, (str, os.PathLike))
+    model_paths = [model_path] if single_model else list(model_path)
+    results_opts = results_opts if results_opts is not None else {}
+
+    if expdata is None:
+        expdata = get_expdata(expdir, tray_slots)
+        if expdata is None:
+            return {}
+
+    total_images = expdata["nimages"]
+    expdir = Path(expdata["path"])
+
+    out_paths = [None] * len(model_paths)
+    if out_path is not None:
+        out_paths = [out_path] if single_model else [model_results_path(out_path, p) for p in model_paths]
+
+    mask_opts = {"backend": masking, "scale": mask_scale, "stride": stride, "aggregate": aggregate}
+    ckpts = None
+    if checkpoint and out_path is not None:
+        # NOTE: A checkpoint of another model or analysis parameters is discarded, not resumed
+        ckpts = [Checkpoint(checkpoint_path(o), analysis_params(p, mask_opts)) for o, p in zip(out_paths, model_paths)]
+
+    items = [item for item in iter_samples(expdata)
+             if ckpts is None or not all(c.is_done(*item[:3]) for c in ckpts)]
+    samples_done = total_images - len(items)
+    if samples_done > 0:
+        print(f" ** Resuming analysis from checkpoint, {samples_done} samples already analyzed")
+
+    cache_opts = {"cache_dir": result_cache_dir, "max_mb": result_cache_mb}
+    if len(items) == 0:
+        analyzed = iter(())
+    elif processes > 1:
+        analyzed = analyze_samples_mp(expdir, items, model_paths, providers, threads,
+                                      session_opts, cache_opts, mask_opts, batch_size, processes, stop, profiler)
+    else:
+        analyzed = analyze_samples(expdir, items, model_paths, providers, threads,
+                                   session_opts, cache_opts, mask_opts, batch_size, workers, prefetch, stop, profiler,
+                                   memory_mb)
+
+    results = None
+    if ckpts is None:
+        results = [expdata["results"]] + [empty_results(expdata) for _ in model_paths[1:]]
+
+    try:
+        analyze_items(expdata, analyzed, ckpts, results, samples_done, progress, profiler)
+        if stop is not None and stop.is_set():
+            return {}
+
+        if ckpts is not None:
+            for ckpt, o in zip(ckpts, out_paths):
+                ckpt.write_results(expdata, o, **results_opts)
+                ckpt.remove()
+            results = [Path(o) for o in out_paths]
+    finally:
+        if ckpts is not None:
+            for ckpt in ckpts:
+                ckpt.close()
+
+    if ckpts is None and out_path is not None:
+        for res, o in zip(results, out_paths):
+            save_results(res, o, **results_opts)
+
+    return results[0] if single_model else results
+
+
+def write_results_atomic(ckpt, expdata, out_path, results_opts=None):
+    # Results file rebuilt from the checkpoint while it may be read (ex: by the thresholder)
+    out_path = Path(out_path)
+    tmp_path = out_path.with_name(f"{out_path.stem}.{os.getpid()}.tmp{out_path.suffix}")
+    ckpt.write_results(expdata, tmp_path, **(results_opts if results_opts is not None else {}))
+    os.replace(tmp_path, out_path)
+
+
+def watch_experiment(expdir,
+                     model_path,
+                     out_path,
+                     providers=None,
+                     threads=0,
+                     session_opts=None,
+                     result_cache_dir=None,
+                     result_cache_mb=RESULT_CACHE_MAX_MB,
+                     masking="auto",
+                     mask_scale=MASK_SCALE,
+                     stride=SUBIMAGE_STRIDE,
+                     aggregate=False,
+                     batch_size=BATCH_SIZE,
+                     workers=DECODE_WORKERS,
+                     prefetch=PREFETCH_SAMPLES,
+                     memory_mb=0,
+                     tray_slots=N_SAMPLES_X_TRAY,
+                     poll=WATCH_POLL_TIME,
+                     settle=WATCH_SETTLE_TIME,
+                     on_update=None,
+                     stop=None,
+                     profiler=None,
+                     results_opts=None
+):
+    """
+        Watch mode: analyzes the images of an experiment folder while they are being acquired, until
+        stop (threading.Event) is set. The models are loaded once, then every poll seconds the folder
+        is scanned again (see get_expdata()) and the images not analyzed yet are queued once their
+        size and modification time have not changed for settle seconds (images still being written
+        are left for the next scans).
+        Score maps are appended to the checkpoint of each model as they are computed, and the results
+        file (out_path, see analyze_experiment() for the other arguments) is rebuilt after each group
+        of new images. The checkpoint is kept when stopping, so watching again (or a normal analysis)
+        resumes from it.
+            - on_update: callback(n_new, samples_done, total_images) called after each group of new images
+            - profiler: profiling.Profiler the stage timings are recorded to, if given
+            - results_opts: score map encoding of the results file (see analyze_experiment())
+    """
+    single_model = isinstance(model_path, (str, os.PathLike))
+    model_paths = [model_path] if single_model else list(model_path)
+    out_paths = [out_path] if single_model else [model_results_path(out_path, p) for p in model_paths]
+    expdir = Path(expdir)
+
+    mask_opts = {"backend": masking, "scale": mask_scale, "stride": stride, "aggregate": aggregate}
+    cache_opts = {"cache_dir": result_cache_dir, "max_mb": result_cache_mb}
+    models = [load_model(p, providers, threads, batch_size, session_opts) for p in model_paths]
+    caches = [open_result_cache(p, cache_opts, mask_opts) for p in model_paths]
+    mask_opts = dict(mask_opts, channels=image_channels(models))
+    batch_buffer = [None]
+    ckpts = [Checkpoint(checkpoint_path(o), analysis_params(p, mask_opts)) for o, p in zip(out_paths, model_paths)]
+
+    seen = {} # item -> (size, mtime) of the images not analyzed yet, as of the last scan
+    try:
+        while stop is None or not stop.is_set():
+            # NOTE: Timepoint folders may not exist yet when the acquisition starts
+            expdata = None
+            if any(f.is_dir() for f in os.scandir(expdir)):
+                expdata = get_expdata(expdir, tray_slots)
+
+            ready = []
+            if expdata is not None:
+                now = time.time()
+                waiting = {}
+                for item in iter_samples(expdata):
+                    if all(c.is_done(*item[:3]) for c in ckpts):
+                        continue
+                    try:
+                        st = os.stat(expdir / item[0] / item[1] / item[3])
+                    except OSError: # Removed or renamed since the scan
+                        continue
+                    waiting[item] = (st.st_size, st.st_mtime_ns)
+                    if seen.get(item) == waiting[item] and now - st.st_mtime >= settle:
+                        ready.append(item)
+                seen = waiting
+
+            if len(ready) > 0:
+                analyzed = score_items(expdir, ready, models, caches, mask_opts, batch_buffer, workers, prefetch, stop,
+                                       profiler, memory_mb)
+                analyze_items(expdata, analyzed, ckpts, None, 0, None, profiler)
+                for ckpt, o in zip(ckpts, out_paths):
+                    write_results_atomic(ckpt, expdata, o, results_opts)
+                if on_update is not None:
+                    samples_done = sum(all(c.is_done(*item[:3]) for c in ckpts) for item in iter_samples(expdata))
+                    on_update(len(ready), samples_done, expdata["nimages"])
+
+            if stop is not None:
+                stop.wait(poll)
+            else:
+                time.sleep(poll)
+    finally:
+        for ckpt in ckpts:
+            ckpt.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Blackbird Samples Analyzer (headless)")
+    parser.add_argument(
+        "expdir",
+        metavar="<EXP_DIR>",
+        help="Path to the Blackbird experiment folder",
+    )
+    parser.add_argument(
+        "model",
+        metavar="<ONNX_MODEL>",
+        nargs="+",
+        help="Path to ONNX classification model used for the analysis. If several models are given, "
+             "each sample is decoded and masked once for all of them and each model gets its own results file",
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        metavar="<OUT_MSGPACK>",
+        required=False,
+        default=None,
+        help="Path of the results file (default: <EXP_DIR>/" + RESULTS_FILENAME + "), or of a results store if its extension is " + RESULTS_STORE_EXT,
+    )
+    parser.add_argument(
+        "--score-encoding",
+        choices=SCORE_ENCODINGS,
+        default="float32",
+        help="Score map encoding of the msgpack results file: float32 (default), float16 (max. error 2^-12) or uint8 (1/255 steps, max. error 1/510)",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="zlib-compress the float16/uint8 score maps of the results file",
+    )
+    parser.add_argument(
+        "-p",
+        "--providers",
+        metavar="<PROVIDERS>",
+        required=False,
+        default=",".join(DEFAULT_PROVIDERS),
+        help="Comma-separated list of ONNX Runtime execution providers, in order of preference. "
+             "Unavailable providers are skipped and " + CPU_BACKEND + " is always the last fallback",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        metavar="<N_THREADS>",
+        default=0,
+        type=int,
+        required=False,
+        help="Number of intra-op inference threads (0 = ONNX Runtime default)",
+    )
+    parser.add_argument(
+        "--inter-threads",
+        metavar="<N_THREADS>",
+        default=0,
+        type=int,
+        required=False,
+        help="Number of inter-op inference threads (0 = ONNX Runtime default)",
+    )
+    parser.add_argument(
+        "--exec-mode",
+        choices=EXECUTION_MODES,
+        default="sequential",
+        required=False,
+        help="ONNX Runtime execution mode",
+    )
+    parser.add_argument(
+        "--opt-level",
+        choices=OPT_LEVELS,
+        default="all",
+        required=False,
+        help="ONNX Runtime graph optimization level",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="<CACHE_DIR>",
+        default=str(MODEL_CACHE_DIR),
+        required=False,
+        help="Folder where optimized models and their infected label index are cached",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use nor write the optimized models cache",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        metavar="<BATCH_SIZE>",
+        default=BATCH_SIZE,
+        type=int,
+        required=False,
+        help="Number of sub-images classified per inference run (0 = all sub-images of a sample at once)",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="<N_WORKERS>",
+        default=DECODE_WORKERS,
+        type=int,
+        required=False,
+        help="Number of threads decoding and masking images while inference runs (0 = sequential)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        metavar="<N_SAMPLES>",
+        default=PREFETCH_SAMPLES,
+        type=int,
+        required=False,
+        help="Max. number of samples decoded ahead of inference",
+    )
+    parser.add_argument(
+        "--max-memory",
+        metavar="<MB>",
+        default=0,
+        type=int,
+        required=False,
+        help="Memory cap of the samples being decoded or waiting for inference, samples wait for it before being read (default: 0 = only --prefetch)",
+    )
+    parser.add_argument(
+        "-j",
+        "--processes",
+        metavar="<N_PROCESSES>",
+        default=1,
+        type=int,
+        required=False,
+        help="Number of worker processes, each one with its own inference session (1 = no worker processes)",
+    )
+    parser.add_argument(
+        "--masking",
+        choices=MASKING_BACKENDS,
+        default="auto",
+        required=False,
+        help="Leaf masking implementation: compiled native module (Windows, Python 3.11), NumPy/OpenCV, "
+             "or native if available",
+    )
+    parser.add_argument(
+        "--mask-scale",
+        metavar="<SCALE>",
+        default=MASK_SCALE,
+        type=float,
+        required=False,
+        help="Compute the leaf mask on a copy of the image downscaled by this factor (0-1], rounded to a "
+             "multiple of 1/6, faster masking but sub-images selection may differ slightly, see test/check_mask_scale.py",
+    )
+    parser.add_argument(
+        "--stride",
+        metavar="<PX>",
+        default=SUBIMAGE_STRIDE,
+        type=int,
+        required=False,
+        help="Distance between consecutive sub-images, a divisor of " + str(SUBIMAGE_WIDTH) + " (ex: 112 or 56). "
+             "Sub-images overlap below " + str(SUBIMAGE_WIDTH) + ", giving finer score maps at the cost of more inference runs",
+    )
+    parser.add_argument(
+        "--aggregate",
+        action="store_true",
+        help="With --stride, aggregate the scores of the overlapping sub-images back to the " + str(SUBIMAGE_WIDTH) +
+             " px sub-image grid (overlap weighted mean), so results have the usual shape",
+    )
+    parser.add_argument(
+        "--tray-slots",
+        metavar="<N_SLOTS>",
+        default=N_SAMPLES_X_TRAY,
+        type=int,
+        required=False,
+        help="Min. number of sample slots of each tray in the results (trays with higher sample numbers get "
+             "more slots, 0 = highest sample number of each tray)",
+    )
+    parser.add_argument(
+        "--result-cache",
+        metavar="<CACHE_DIR>",
+        default=str(RESULT_CACHE_DIR),
+        required=False,
+        help="Folder of the score maps cache, images already analyzed with the same model and parameters are not analyzed again",
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        metavar="<MB>",
+        default=RESULT_CACHE_MAX_MB,
+        type=float,
+        required=False,
+        help="Maximum size of the score maps cache in MB (least recently used entries are evicted)",
+    )
+    parser.add_argument(
+        "--no-result-cache",
+        action="store_true",
+        help="Do not use nor write the score maps cache",
+    )
+    parser.add_argument(
+        "--no-checkpoint",
+        action="store_true",
+        help="Keep all results in memory instead of checkpointing each sample (a stopped analysis can't be resumed)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Watch mode: keep running and analyze the new images of the experiment folder as they are written "
+             "(results file updated after each group of new images, stop with Ctrl+C)",
+    )
+    parser.add_argument(
+        "--poll",
+        metavar="<SECONDS>",
+        default=WATCH_POLL_TIME,
+        type=float,
+        required=False,
+        help="Watch mode: time between scans of the experiment folder",
+    )
+    parser.add_argument(
+        "--settle",
+        metavar="<SECONDS>",
+        default=WATCH_SETTLE_TIME,
+        type=float,
+        required=False,
+        help="Watch mode: time an image must stay unmodified before it is analyzed (images being written are skipped)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="<OUT_PREFIX>",
+        default=None,
+        required=False,
+        help="Record the time of each analysis stage of every sample, print a percentiles summary at the end and save "
+             "them to <OUT_PREFIX>" + JSONL_EXT + " (one JSON line per sample) and <OUT_PREFIX>" + TRACE_EXT +
+             " (Chrome/Perfetto trace)",
+    )
+    parser.add_argument(
+        "--progress",
+        choices=["line", "log", "none"],
+        default="line",
+        required=False,
+        help="Progress reporting: single updating line, one log line per sample, or none",
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.expdir):
+        print(herror + " Specified experiment folder " + args.expdir + " does not exist!")
+        exit()
+
+    for model in args.model:
+        if not os.path.exists(model):
+            print(herror + " Specified model path " + model + " does not exist!")
+            exit()
+
+        if os.path.splitext(model)[-1] != ".onnx":
+            print(herror + " The specified model " + model + " is not in ONNX format!")
+            exit()
+
+    if len(set(Path(m).stem for m in args.model)) != len(args.model):
+        print(herror + " The specified models must have different file names!")
+        exit()
+
+    if args.batch < 0 or args.threads < 0 or args.inter_threads < 0 or args.workers < 0 or args.prefetch < 1 or args.processes < 1 \
+            or args.max_memory < 0:
+        print(herror + " The specified batch size, number of threads/workers, prefetch or memory cap is not valid!")
+        exit()
+
+    if args.max_memory > 0 and args.processes > 1:
+        print(hwarning + "--max-memory is ignored with several processes (each one analyzes a sample at a time)")
+
+    if args.tray_slots < 0:
+        print(herror + " The specified number of tray slots is not valid!")
+        exit()
+
+    if not 0 < args.mask_scale <= 1:
+        print(herror + " The specified mask scale is not valid!")
+        exit()
+
+    if args.stride <= 0 or SUBIMAGE_WIDTH % args.stride != 0 or SUBIMAGE_HEIGHT % args.stride != 0:
+        print(herror + f" The specified stride must be a divisor of {SUBIMAGE_WIDTH}!")
+        exit()
+
+    try:
+        masking = resolve_backend(args.masking)
+    except ImportError as e:
+        print(herror + " " + str(e) + "!")
+        exit()
+
+    out_path = args.out if args.out is not None else Path(args.expdir) / RESULTS_FILENAME
+    profiler = Profiler() if args.profile is not None else None
+
+    if args.compress and args.score_encoding == "float32":
+        print(herror + " --compress requires the float16 or uint8 score encoding!")
+        exit()
+    if (args.score_encoding != "float32" or args.compress) and is_results_store(out_path):
+        print(herror + " The compact score encoding is only available in msgpack results files!")
+        exit()
+    results_opts = {"encoding": args.score_encoding, "compress": args.compress}
+
+    def save_profile():
+        print(" ** Analysis stages:")
+        profiler.print_summary()
+        for path in profiler.save(args.profile):
+            print("Profile saved to:", os.path.abspath(path))
+
+    def print_progress(done, total, etc):
+        msg = f" ** {done}/{total} samples processed ({int(done/total*100)}%) - ETC {format_etc(etc)}"
+        print(msg, end='\r' if args.progress == "line" else '\n')
+
+    if args.watch:
+        if args.no_checkpoint or args.processes > 1:
+            print(herror + " Watch mode can't be used with --no-checkpoint nor several processes!")
+            exit()
+        if args.poll <= 0 or args.settle < 0:
+            print(herror + " The specified poll or settle time is not valid!")
+            exit()
+
+        def print_update(n_new, done, total):
+            print(f" ** {time.strftime('%H:%M:%S')} {n_new} new samples analyzed, {done}/{total} samples processed")
+
+        print(f" ** Watching {os.path.abspath(args.expdir)} for new images (Ctrl+C to stop)...")
+        stop = threading.Event()
+        try:
+            watch_experiment(args.expdir,
+                             args.model[0] if len(args.model) == 1 else args.model,
+                             out_path,
+                             providers=[p.strip() for p in args.providers.split(",") if p.strip()],
+                             threads=args.threads,
+                             session_opts={"inter_threads": args.inter_threads,
+                                           "execution_mode": args.exec_mode,
+                                           "opt_level": args.opt_level,
+                                           "cache_dir": None if args.no_cache else args.cache_dir},
+                             result_cache_dir=None if args.no_result_cache else args.result_cache,
+                             result_cache_mb=args.result_cache_size,
+                             masking=masking,
+                             mask_scale=args.mask_scale,
+                             stride=args.stride,
+                             aggregate=args.aggregate,
+                             batch_size=args.batch,
+                             workers=args.workers,
+                             prefetch=args.prefetch,
+                             memory_mb=args.max_memory,
+                             tray_slots=args.tray_slots,
+                             poll=args.poll,
+                             settle=args.settle,
+                             on_update=print_update if args.progress != "none" else None,
+                             stop=stop,
+                             profiler=profiler,
+                             results_opts=results_opts)
+        except KeyboardInterrupt:
+            stop.set()
+        print(" ** Watch mode stopped")
+        if profiler is not None:
+            save_profile()
+        for model in args.model:
+            print(f"Results of {model} saved to:", os.path.abspath(out_path if len(args.model) == 1 else model_results_path(out_path, model)))
+        exit()
+
+    start = time.time()
+    results = analyze_experiment(args.expdir,
+                                 args.model[0] if len(args.model) == 1 else args.model,
+                                 providers=[p.strip() for p in args.providers.split(",") if p.strip()],
+                                 threads=args.threads,
+                                 session_opts={"inter_threads": args.inter_threads,
+                                               "execution_mode": args.exec_mode,
+                                               "opt_level": args.opt_level,
+                                               "cache_dir": None if args.no_cache else args.cache_dir},
+                                 result_cache_dir=None if args.no_result_cache else args.result_cache,
+                                 result_cache_mb=args.result_cache_size,
+                                 masking=masking,
+                                 mask_scale=args.mask_scale,
+                                 stride=args.stride,
+                                 aggregate=args.aggregate,
+                                 batch_size=args.batch,
+                                 workers=args.workers,
+                                 prefetch=args.prefetch,
+                                 memory_mb=args.max_memory,
+                                 processes=args.processes,
+                                 out_path=out_path,
+                                 results_opts=results_opts,
+                                 checkpoint=not args.no_checkpoint,
+                                 progress=print_progress if args.progress != "none" else None,
+                                 tray_slots=args.tray_slots,
+                                 profiler=profiler)
+    if args.progress == "line":
+        print()
+
+    if profiler is not None:
+        save_profile()
+
+    if results:
+        print(f" ** Done in {format_etc(time.time()-start)}")
+        if len(args.model) == 1:
+            print("Results saved to:", os.path.abspath(out_path))
+        else:
+            for model in args.model:
+                print(f"Results of {model} saved to:", os.path.abspath(model_results_path(out_path, model)))
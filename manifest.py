@@ -0,0 +1,117 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+
+
+# Useful colored strings
+hwarning = "\033[93m[WARNING]\033[0m: "
+
+MANIFEST_FILENAME = "manifest.msgpack"
+MANIFEST_VERSION = 1
+SCAN_WORKERS = 8            # Folders listed at the same time when (re)building the manifest
+IMAGE_EXT = ".png"
+
+
+def load_manifest(expdir):
+    # Manifest saved in the experiment folder, or an empty one if missing, unreadable or outdated
+    try:
+        with open(Path(expdir) / MANIFEST_FILENAME, "rb") as f:
+            manifest = msgpack.unpackb(f.read())
+    except (OSError, ValueError, msgpack.UnpackException):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["dates"]
+
+
+def save_manifest(expdir, dates):
+    # Written to a temporary file first, a reader never finds a partially written manifest
+    path = Path(expdir) / MANIFEST_FILENAME
+    tmp_path = str(path) + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(msgpack.packb({"version": MANIFEST_VERSION, "dates": dates}))
+    os.replace(tmp_path, path)
+
+
+def scan_tray(path):
+    """
+        Lists the sample images of a tray folder (<NNN-ID>.png). Returns the tray entry of the
+        manifest: folder mtime and [sample_number, filename, size, mtime] of each image.
+    """
+    # NOTE: The folder mtime is read before listing it, so images added meanwhile trigger a rescan
+    mtime = os.stat(path).st_mtime_ns
+    images = []
+    for f in os.scandir(path):
+        if not f.name.endswith(IMAGE_EXT) or not f.is_file():
+            continue
+        try:
+            nsample = int(f.name.split('-')[0])
+        except ValueError:
+            print(hwarning + f"Image '{f.path}' does not start with its sample number, skipped.")
+            continue
+        st = f.stat()
+        images.append([nsample, f.name, st.st_size, st.st_mtime_ns])
+    images.sort(key=lambda x: x[1])
+    return {"mtime": mtime, "images": images}
+
+
+def scan_date(path):
+    # Date entry of the manifest: folder mtime and its tray folders (entries filled by scan_tray())
+    mtime = os.stat(path).st_mtime_ns
+    return {"mtime": mtime, "trays": {name: None for name in sorted(f.name for f in os.scandir(path) if f.is_dir())}}
+
+
+def _refresh(scan, path, entry):
+    # Entry of a folder from the previous manifest if its mtime did not change, else rescanned
+    if entry is not None and os.stat(path).st_mtime_ns == entry["mtime"]:
+        return entry, False
+    return scan(path), True
+
+
+def update_manifest(expdir, workers=SCAN_WORKERS):
+    """
+        Returns the manifest of the experiment folder, {date: {tray: [[sample_number, filename,
+        size, mtime], ...]}}, for all its date sub-folders (in folder listing order).
+        The manifest saved in the experiment folder (MANIFEST_FILENAME) is reused: only the date
+        and tray folders whose mtime changed since it was saved are listed again, several at a
+        time, and it is saved again if anything changed.
+    """
+    expdir = Path(expdir)
+    old = load_manifest(expdir)
+    datefolders = [f.name for f in os.scandir(expdir) if f.is_dir()]
+
+    def refresh_date(d):
+        return _refresh(scan_date, expdir / d, old.get(d))
+
+    def refresh_tray(dt):
+        d, t = dt
+        return _refresh(scan_tray, expdir / d / t, old[d]["trays"].get(t) if d in old else None)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        scanned_dates = list(pool.map(refresh_date, datefolders))
+        dates = {d: {"mtime": entry["mtime"], "trays": {}} for d, (entry, _) in zip(datefolders, scanned_dates)}
+        trays = [(d, t) for d, (entry, _) in zip(datefolders, scanned_dates) for t in entry["trays"]]
+        scanned_trays = list(pool.map(refresh_tray, trays))
+
+    for (d, t), (entry, _) in zip(trays, scanned_trays):
+        dates[d]["trays"][t] = entry
+
+    changed = set(old) != set(dates) or any(c for _, c in scanned_dates + scanned_trays)
+    if changed:
+        try:
+            save_manifest(expdir, dates)
+        except OSError as e:
+            print(hwarning + f"Experiment manifest could not be saved ({e}), the folder will be scanned again next time.")
+
+    return {d: {t: dates[d]["trays"][t]["images"] for t in dates[d]["trays"]} for d in dates}
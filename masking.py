@@ -0,0 +1,141 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+from functools import partial
+
+import numpy as np
+import cv2
+
+
+MASKING_BACKENDS = ["auto", "native", "numpy"]
+
+TEXTURE_STEP = 6            # px, distance between texture grid cells
+TEXTURE_WINDOW = 50         # px, side of the window the texture of each cell is measured on
+TEXTURE_BAND = 32           # Texture grid rows computed at once (caps memory on large images)
+MIN_LEAF_AREA = 0.15        # Minimum leaf area ratio of the texture grid to be considered a sample
+ERODE_ITERATIONS = 10       # 3x3 erosions applied to the leaf mask, before and after selecting the leaf
+BORDER_ERODE_ITERATIONS = 4 # 3x3 erosions applied after clearing the grid border
+
+_native = {}
+
+
+def native_available():
+    # True if the compiled leaf masking module (cpp_functions/leaf_masking.*.pyd) can be imported here
+    if "module" not in _native:
+        try:
+            import cpp_functions.leaf_masking as leaf_masking
+            _native["module"] = leaf_masking
+        except ImportError:
+            _native["module"] = None
+    return _native["module"] is not None
+
+
+def resolve_backend(backend="auto"):
+    # "auto" is the native module when available, else the NumPy/OpenCV implementation
+    if backend not in MASKING_BACKENDS:
+        raise ValueError(f"Unknown leaf masking backend '{backend}'")
+    if backend == "auto":
+        return "native" if native_available() else "numpy"
+    if backend == "native" and not native_available():
+        raise ImportError("The native leaf masking module is not available for this platform/Python version")
+    return backend
+
+
+def get_process(backend="auto", step=TEXTURE_STEP):
+    # Returns the process(img, rel_threshold) function of the leaf masking backend for a texture grid step
+    # NOTE: The native module has a fixed step, downscaled images (step < TEXTURE_STEP) are masked with process()
+    if resolve_backend(backend) == "native" and step == TEXTURE_STEP:
+        return _native["module"].process
+    return process if step == TEXTURE_STEP else partial(process, step=step)
+
+
+def texture_step(scale):
+    # Texture grid step of a copy of the image downscaled by scale (the image is downscaled by step/TEXTURE_STEP)
+    return min(max(round(TEXTURE_STEP * scale), 1), TEXTURE_STEP)
+
+
+def texture_grid(img, step=TEXTURE_STEP):
+    """
+        Max. standard deviation of the RGB channels in a TEXTURE_WINDOW window every TEXTURE_STEP
+        pixels. Window sums come from integral images of bands of the image.
+        step: grid step of a copy of the image downscaled by step/TEXTURE_STEP, the window is scaled
+        likewise so the grid cells cover the same areas of the image as at full resolution.
+    """
+    im_h, im_w = img.shape[:2]
+    window = round(TEXTURE_WINDOW * step / TEXTURE_STEP)
+    # NOTE: Same grid size as the native module (last windows end a few pixels before the image border)
+    grid_h = im_h // step - 8
+    grid_w = im_w // step - 8
+    n = window * window
+
+    grid = np.empty((max(grid_h, 0), max(grid_w, 0)), dtype=np.float64)
+    x_end = step * (grid_w - 1) + 1
+    for r0 in range(0, grid_h, TEXTURE_BAND):
+        r1 = min(r0 + TEXTURE_BAND, grid_h)
+        y_end = step * (r1 - r0 - 1) + 1
+        band = img[step*r0 : step*(r1-1) + window]
+        # Exact integer sums stored as float64
+        sums = cv2.integral2(band, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+        moments = []
+        for integral in sums:
+            top = integral[0:y_end:step]
+            bottom = integral[window:window+y_end:step]
+            moments.append((bottom[:, window:window+x_end:step] - bottom[:, 0:x_end:step]
+                            - top[:, window:window+x_end:step] + top[:, 0:x_end:step]) / n)
+        mean, sq_mean = moments
+        grid[r0:r1] = np.sqrt(np.maximum(sq_mean - mean*mean, 0)).max(axis=2)
+    return grid
+
+
+def fill_holes(mask):
+    # Background regions not 4-connected to the mask border are filled
+    padded = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    cv2.floodFill(padded, None, (0, 0), 255, flags=4)
+    filled = mask.copy()
+    filled[padded[1:-1, 1:-1] == 0] = 255
+    return filled
+
+
+def process(img, rel_threshold, step=TEXTURE_STEP):
+    """
+        NumPy/OpenCV implementation of the native leaf masking algorithm (cpp_functions.leaf_masking).
+        Takes an RGB uint8 image and returns its uint8 leaf mask (0 or 255, same size as the image),
+        or None if no sample is found in it.
+        The leaf is the largest low texture region: texture cells below the mean texture of the cells
+        over rel_threshold * max. texture.
+        step: texture grid step, < TEXTURE_STEP for a downscaled image (see texture_grid()). Erosions
+        are done on the grid, so they also cover the same areas of the image as at full resolution.
+    """
+    grid = texture_grid(img, step)
+    if grid.size == 0:
+        return None
+
+    # NOTE: The native module takes the threshold as float32
+    high = grid > float(np.float32(rel_threshold)) * grid.max()
+    high_mean = grid[high].mean() if high.any() else 0.0
+    mask = np.where(grid > high_mean, 0, 255).astype(np.uint8)
+
+    mask = fill_holes(mask)
+    mask = cv2.erode(mask, None, iterations=ERODE_ITERATIONS)
+    mask[[0, -1], :] = 0
+    mask[:, [0, -1]] = 0
+    mask = cv2.erode(mask, None, iterations=BORDER_ERODE_ITERATIONS)
+    mask = fill_holes(mask)
+
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if n_labels < 2:
+        return None
+    leaf = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    if stats[leaf, cv2.CC_STAT_AREA] < MIN_LEAF_AREA * mask.size:
+        return None
+
+    mask = np.where(labels == leaf, 255, 0).astype(np.uint8)
+    mask = cv2.erode(mask, None, iterations=ERODE_ITERATIONS)
+    return cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
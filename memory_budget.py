@@ -0,0 +1,79 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import threading
+
+
+DECODE_FACTOR = 2           # Decoded image copies alive while decoding (image + decoder scratch buffer)
+
+
+class MemoryBudget:
+    """
+        Caps the memory of the sample images in flight (being read, decoded and masked, or waiting for
+        inference) to max_bytes. Each sample reserves its estimated memory before its file is read:
+            - while being prepared: file size + DECODE_FACTOR * decoded image size
+            - once prepared, until it is scored: decoded image size
+        The decoded image size is the largest one seen so far; the first sample reserves the whole
+        budget, as it is not known yet.
+        Reservations are granted in sample order (ticket()), so samples waiting for budget never
+        hold back the ones the consumer is waiting for. A sample is always let through when nothing
+        else is reserved, so images larger than the budget are analyzed one at a time.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self.image_bytes = None     # Largest decoded image seen
+        self._tickets = 0
+        self._serving = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def ticket(self):
+        # Position of the next sample in the reservation order (taken in the order samples are consumed)
+        with self._cond:
+            self._tickets += 1
+            return self._tickets - 1
+
+    def estimate(self, file_bytes):
+        # Bytes to reserve to prepare a sample with a file of file_bytes
+        if self.image_bytes is None:
+            return self.max_bytes
+        return file_bytes + DECODE_FACTOR * self.image_bytes
+
+    def reserve(self, ticket, nbytes):
+        # Blocks until it is the turn of the ticket and nbytes fit in the budget, False if closed meanwhile
+        with self._cond:
+            while not self._closed and (ticket != self._serving or
+                                        (self.used > 0 and self.used + nbytes > self.max_bytes)):
+                self._cond.wait()
+            if self._closed:
+                return False
+            self._serving += 1
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+            self._cond.notify_all()
+            return True
+
+    def release(self, nbytes):
+        # Gives back nbytes (negative to take them, without waiting: image larger than estimated)
+        with self._cond:
+            self.used -= nbytes
+            self.peak = max(self.peak, self.used)
+            self._cond.notify_all()
+
+    def close(self):
+        # Wakes up the samples waiting for budget (ex: analysis stopped), see reserve()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def seen_image(self, nbytes):
+        with self._cond:
+            self.image_bytes = max(self.image_bytes or 0, nbytes)
@@ -1,4 +1,3 @@
- 
 input_model_file = "PMnet.mat";
 
 [~, basename, ext] = fileparts(input_model_file);
@@ -10,4 +9,6 @@ net = net.(varnames{1});
 
 % Needs to download this function from:
 % https://mathworks.com/matlabcentral/fileexchange/67296-deep-learning-toolbox-converter-for-onnx-model-format
-exportONNXNetwork(net, output_model_file, 'BatchSize', 1);
\ No newline at end of file
+% NOTE: 'BatchSize' is left unspecified so the exported model has a dynamic batch axis
+% (required by the analyzer batched inference)
+exportONNXNetwork(net, output_model_file);
@@ -0,0 +1,82 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+import argparse
+
+import onnx
+from onnx import numpy_helper
+
+
+# Useful colored strings
+hwarning = "\033[93m[WARNING]\033[0m: "
+herror = "\033[91m[ERROR]\033[0m: "
+
+BATCH_DIM_NAME = "N"
+
+
+def make_batch_dynamic(model):
+    """
+        Replaces the fixed batch dimension (exported by MATLAB with 'BatchSize', 1) of the model
+        inputs and outputs by a symbolic one. Reshape nodes with a hardcoded batch of 1 are changed
+        to copy the batch dimension from their input instead.
+    """
+    graph = model.graph
+    initializer_names = {init.name for init in graph.initializer}
+
+    for tensor in list(graph.input) + list(graph.output):
+        if tensor.name in initializer_names:
+            continue
+        dims = tensor.type.tensor_type.shape.dim
+        if len(dims):
+            dims[0].Clear()
+            dims[0].dim_param = BATCH_DIM_NAME
+
+    # Reshape target shapes are usually stored as initializers
+    reshape_shapes = {n.input[1] for n in graph.node if n.op_type == "Reshape" and len(n.input) > 1}
+    for i, init in enumerate(graph.initializer):
+        if init.name not in reshape_shapes:
+            continue
+        shape = numpy_helper.to_array(init).copy()
+        if shape.ndim == 1 and len(shape) and shape[0] == 1:
+            shape[0] = 0 # 0 -> copy dimension from the input tensor
+            graph.initializer[i].CopyFrom(numpy_helper.from_array(shape, init.name))
+
+    # Intermediate shapes are inferred again by the runtime
+    del graph.value_info[:]
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ONNX model dynamic batch converter")
+    parser.add_argument(
+        "model",
+        metavar="<ONNX_MODEL>",
+        help="Path to the ONNX model exported with a fixed batch size",
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        metavar="<OUT_ONNX>",
+        required=False,
+        default=None,
+        help="Path of the converted model (default: overwrite input model)",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(herror + " Specified model path " + args.model + " does not exist!")
+        exit()
+
+    model = make_batch_dynamic(onnx.load(args.model))
+    onnx.checker.check_model(model)
+
+    out_path = args.out if args.out is not None else args.model
+    onnx.save(model, out_path)
+    print("Model with dynamic batch axis saved to:", os.path.abspath(out_path))
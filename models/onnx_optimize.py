@@ -0,0 +1,389 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import onnx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from engine import BATCH_SIZE, get_expdata, iter_samples, prepare_sample, score_sample_models, tile_view, load_model
+from masking import MASKING_BACKENDS, resolve_backend
+from thresholder import sweep_counts, infection_percent
+
+# NOTE: onnxruntime.quantization and onnxruntime.transformers are only imported when a model is converted
+
+
+# Useful colored strings
+hwarning = "\033[93m[WARNING]\033[0m: "
+herror = "\033[91m[ERROR]\033[0m: "
+
+FORMATS = ["int8", "fp16"]
+CALIB_TILES = 512           # In focus sub-images the INT8 activation ranges are calibrated on
+CALIB_TILES_X_SAMPLE = 32   # Max. calibration sub-images taken from a single sample
+CALIB_BATCH = 16
+COMPARE_SAMPLES = 50        # Samples scored by every model in the comparison (0 = all)
+PERCENT_TOLERANCE = 1.0     # Max. infected % difference (points) for a model to agree with the float32 one
+
+
+def random_items(expdata, n, seed=0):
+    # n samples of the experiment picked at random (all of them, shuffled, if n <= 0)
+    items = list(iter_samples(expdata))
+    order = np.random.default_rng(seed).permutation(len(items))
+    return [items[i] for i in (order[:n] if n > 0 else order)]
+
+
+def calibration_tiles(expdata, n_tiles, mask_opts=None, seed=0):
+    """
+        Returns up to n_tiles in focus sub-images (N x 3 x H x W float32, same input as the analysis)
+        from random samples of the experiment, at most CALIB_TILES_X_SAMPLE from each sample.
+    """
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for date, tray, _, sample in random_items(expdata, 0, seed):
+        if len(tiles) >= n_tiles:
+            break
+        prepared = prepare_sample(Path(expdata["path"]) / date / tray / sample, mask_opts=mask_opts)
+        if prepared is None:
+            continue
+        on_focus = prepared["focus"]
+        focus_i, focus_j = np.nonzero(on_focus)
+        view = tile_view(prepared["image"], prepared["xi"], prepared["yi"], on_focus.shape[1], on_focus.shape[0])
+        for k in rng.choice(len(focus_i), min(len(focus_i), CALIB_TILES_X_SAMPLE, n_tiles - len(tiles)), replace=False):
+            tiles.append(view[focus_i[k], focus_j[k]].transpose(2, 0, 1).astype(np.float32))
+        print(f" ** {len(tiles)}/{n_tiles} calibration sub-images sampled", end='\r')
+    print()
+    return np.stack(tiles) if len(tiles) else None
+
+
+def make_calibration_reader(model_path, tiles):
+    # ONNX Runtime calibration data reader feeding the sub-images in batches the model accepts
+    from onnxruntime.quantization import CalibrationDataReader
+
+    model = onnx.load(model_path, load_external_data=False)
+    in_tensor = model.graph.input[0]
+    batch_dim = in_tensor.type.tensor_type.shape.dim[0]
+    fixed = batch_dim.HasField("dim_value") and batch_dim.dim_value > 0
+    batch = batch_dim.dim_value if fixed else CALIB_BATCH
+    n_tiles = len(tiles) - len(tiles) % batch if fixed else len(tiles) # Fixed batch models only take full batches
+
+    class TileReader(CalibrationDataReader):
+        def __init__(self):
+            self._batches = iter([tiles[i:i+batch] for i in range(0, n_tiles, batch)])
+
+        def get_next(self):
+            data = next(self._batches, None)
+            return {in_tensor.name: data} if data is not None else None
+
+    return TileReader()
+
+
+def quantize_int8(model_path, out_path, tiles, per_channel=False):
+    """
+        Static INT8 quantization (QDQ format, uint8 activations and int8 weights) with the activation
+        ranges calibrated on the given sub-images.
+    """
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Shape inference and graph optimization, recommended before quantizing
+        # NOTE: ONNX shape inference is enough for the CNNs (no symbolic shapes, avoids the sympy dependency)
+        pre_path = os.path.join(tmp_dir, "preprocessed.onnx")
+        quant_pre_process(str(model_path), pre_path, skip_symbolic_shape=True)
+        quantize_static(pre_path, str(out_path), make_calibration_reader(pre_path, tiles),
+                        quant_format=QuantFormat.QDQ,
+                        per_channel=per_channel,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8)
+
+
+def convert_fp16(model_path, out_path):
+    # Float16 weights and activations, inputs and outputs are kept float32 (same interface as the original)
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    model = convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+    onnx.save(model, out_path)
+
+
+def compare_models(expdata, reference, candidates, items, low, high, providers=None, threads=0,
+                   batch_size=BATCH_SIZE, mask_opts=None, tolerance=PERCENT_TOLERANCE):
+    """
+        Scores the samples (items) with the float32 reference model and each candidate model, and
+        compares the sub-image scores and the thresholded INF/CLR counts and infected % of every
+        sample against the reference. A candidate agrees with the reference if no infected % differs
+        by more than tolerance points. Returns a report dict with one entry per candidate.
+    """
+    paths = [reference] + list(candidates)
+    models = [load_model(p, providers, threads, batch_size, {"cache_dir": None}) for p in paths]
+    batch_buffer = [None]
+
+    keys = []
+    score_maps = [[] for _ in paths]
+    times = np.zeros(len(paths))
+    n_tiles = 0
+    for n, (date, tray, _, sample) in enumerate(items):
+        prepared = prepare_sample(Path(expdata["path"]) / date / tray / sample, mask_opts=mask_opts)
+        if prepared is None:
+            continue
+        for k, model in enumerate(models):
+            start = time.perf_counter()
+            score_maps[k].append(score_sample_models([model], prepared, batch_buffer)[0])
+            times[k] += time.perf_counter() - start
+        keys.append(f"{date}/{tray}/{sample}")
+        n_tiles += np.count_nonzero(prepared["focus"])
+        print(f" ** {n+1}/{len(items)} samples compared", end='\r')
+    print()
+    if len(keys) == 0:
+        return None
+
+    lows, highs = np.array([low]), np.array([high])
+    n_all, ref_inf, ref_clr = sweep_counts(score_maps[0], lows, highs)
+    ref_percent = infection_percent(ref_inf, ref_clr, lows, highs)[:, 0, 0]
+    ref_scores = np.concatenate([s[~np.isnan(s)] for s in score_maps[0]])
+
+    def classes(scores):
+        # 1 = INF, -1 = CLR, 0 = between the thresholds
+        return np.where(scores >= high, 1, np.where(scores < low, -1, 0))
+
+    report = {"reference": str(reference), "low": low, "high": high, "tolerance": tolerance,
+              "samples": len(keys), "tiles": int(n_tiles),
+              "reference_ms_per_tile": float(times[0] / max(n_tiles, 1) * 1000), "candidates": []}
+    for k in range(1, len(paths)):
+        _, inf, clr = sweep_counts(score_maps[k], lows, highs)
+        percent = infection_percent(inf, clr, lows, highs)[:, 0, 0]
+        scores = np.concatenate([s[~np.isnan(s)] for s in score_maps[k]])
+        delta = np.abs(scores.astype(np.float64) - ref_scores)
+
+        # Undefined % (no INF nor CLR sub-images) on one side only counts as a full disagreement
+        both_nan = np.isnan(percent) & np.isnan(ref_percent)
+        percent_delta = np.where(both_nan, 0, np.nan_to_num(np.abs(percent - ref_percent), nan=100))
+        disagree = np.nonzero(percent_delta > tolerance)[0]
+
+        report["candidates"].append({
+            "model": str(paths[k]),
+            "ms_per_tile": float(times[k] / max(n_tiles, 1) * 1000),
+            "speedup": float(times[0] / times[k]) if times[k] > 0 else None,
+            "score_delta_mean": float(delta.mean()) if len(delta) else 0.0,
+            "score_delta_p99": float(np.percentile(delta, 99)) if len(delta) else 0.0,
+            "score_delta_max": float(delta.max()) if len(delta) else 0.0,
+            "tiles_changed_class": int(np.count_nonzero(classes(scores) != classes(ref_scores))),
+            "inf_delta": int(np.abs(inf[:, 0] - ref_inf[:, 0]).sum()),
+            "clr_delta": int(np.abs(clr[:, 0] - ref_clr[:, 0]).sum()),
+            "samples_inf_changed": int(np.count_nonzero(inf[:, 0] != ref_inf[:, 0])),
+            "samples_clr_changed": int(np.count_nonzero(clr[:, 0] != ref_clr[:, 0])),
+            "percent_delta_max": float(percent_delta.max()),
+            "percent_delta_mean": float(percent_delta.mean()),
+            "agree": bool(len(disagree) == 0),
+            "disagreements": [{"sample": keys[i], "reference_percent": float(ref_percent[i]),
+                               "percent": float(percent[i])} for i in disagree],
+        })
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['samples']} samples, {report['tiles']} sub-images, thresholds {report['low']}/{report['high']}, "
+          f"float32 {report['reference_ms_per_tile']:.2f} ms/sub-image")
+    print(f"{'Model':<28} {'ms/sub-im':>9} {'Speedup':>8} {'Mean d':>8} {'P99 d':>8} {'Max d':>8} "
+          f"{'Class d':>7} {'INF d':>6} {'CLR d':>6} {'Max %d':>7}  Agree")
+    for c in report["candidates"]:
+        print(f"{Path(c['model']).name:<28} {c['ms_per_tile']:9.2f} {c['speedup'] or 0:7.2f}x "
+              f"{c['score_delta_mean']:8.4f} {c['score_delta_p99']:8.4f} {c['score_delta_max']:8.4f} "
+              f"{c['tiles_changed_class']:7d} {c['inf_delta']:6d} {c['clr_delta']:6d} {c['percent_delta_max']:7.1f}  {'yes' if c['agree'] else 'NO'}")
+        for d in c["disagreements"][:10]:
+            print(f"    {d['sample']}: {d['reference_percent']:.0f}% -> {d['percent']:.0f}%")
+        if len(c["disagreements"]) > 10:
+            print(f"    ... {len(c['disagreements']) - 10} more samples")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="INT8/FP16 ONNX model optimizer and accuracy comparison against "
+                                                 "the float32 model")
+    parser.add_argument(
+        "model",
+        metavar="<ONNX_MODEL>",
+        help="Path to the float32 ONNX model",
+    )
+    parser.add_argument(
+        "expdir",
+        metavar="<EXP_DIR>",
+        help="Experiment folder the calibration sub-images and comparison samples are taken from",
+    )
+    parser.add_argument(
+        "-f",
+        "--formats",
+        metavar="<FORMATS>",
+        default=",".join(FORMATS),
+        required=False,
+        help="Comma-separated list of model variants to produce: int8 (static quantization) and/or fp16",
+    )
+    parser.add_argument(
+        "-o",
+        "--out-dir",
+        metavar="<OUT_DIR>",
+        default=None,
+        required=False,
+        help="Folder of the produced models <MODEL>_int8.onnx, <MODEL>_fp16.onnx and the comparison report "
+             "(default: folder of the model)",
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="<ONNX_MODEL>",
+        nargs="+",
+        default=None,
+        required=False,
+        help="Only compare these already optimized models against the float32 model",
+    )
+    parser.add_argument(
+        "--calib-tiles",
+        metavar="<N>",
+        default=CALIB_TILES,
+        type=int,
+        required=False,
+        help="Number of in focus sub-images used to calibrate the INT8 model",
+    )
+    parser.add_argument(
+        "--per-channel",
+        action="store_true",
+        help="INT8: quantize the weights per channel (usually more accurate, slower on some CPUs)",
+    )
+    parser.add_argument(
+        "-n",
+        "--samples",
+        metavar="<N>",
+        default=COMPARE_SAMPLES,
+        type=int,
+        required=False,
+        help="Number of random samples of the experiment scored by every model (0 = all)",
+    )
+    parser.add_argument(
+        "-lo",
+        "--low",
+        metavar="<LOW_TH>",
+        default=0.5,
+        type=float,
+        required=False,
+        help="Lower threshold of the INF/CLR counts compared",
+    )
+    parser.add_argument(
+        "-hi",
+        "--high",
+        metavar="<HIGH_TH>",
+        default=0.5,
+        type=float,
+        required=False,
+        help="Higher threshold of the INF/CLR counts compared",
+    )
+    parser.add_argument(
+        "--tolerance",
+        metavar="<POINTS>",
+        default=PERCENT_TOLERANCE,
+        type=float,
+        required=False,
+        help="Max. infected %% difference of a sample for an optimized model to agree with the float32 one",
+    )
+    parser.add_argument(
+        "-p",
+        "--providers",
+        metavar="<PROVIDERS>",
+        default="CPUExecutionProvider",
+        required=False,
+        help="Comma-separated list of ONNX Runtime execution providers the models are compared on",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        metavar="<N_THREADS>",
+        default=0,
+        type=int,
+        required=False,
+        help="Number of intra-op inference threads (0 = ONNX Runtime default)",
+    )
+    parser.add_argument(
+        "--masking",
+        choices=MASKING_BACKENDS,
+        default="auto",
+        required=False,
+        help="Leaf masking implementation",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        metavar="<SEED>",
+        default=0,
+        type=int,
+        required=False,
+        help="Random seed of the calibration sub-images and comparison samples",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(herror + " Specified model path " + args.model + " does not exist!")
+        exit()
+
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    if any(f not in FORMATS for f in formats):
+        print(herror + " The specified model formats are not valid (" + ", ".join(FORMATS) + ")!")
+        exit()
+
+    expdata = get_expdata(args.expdir)
+    if expdata is None:
+        exit()
+
+    try:
+        mask_opts = {"backend": resolve_backend(args.masking)}
+    except ImportError as e:
+        print(herror + " " + str(e) + "!")
+        exit()
+
+    out_dir = Path(args.out_dir) if args.out_dir is not None else Path(args.model).parent
+    os.makedirs(out_dir, exist_ok=True)
+    stem = Path(args.model).stem
+
+    candidates = args.compare
+    if candidates is None:
+        candidates = []
+        if "int8" in formats:
+            tiles = calibration_tiles(expdata, args.calib_tiles, mask_opts, args.seed)
+            if tiles is None:
+                print(herror + " No sub-images in focus found in the experiment to calibrate the INT8 model!")
+                exit()
+            out_path = out_dir / f"{stem}_int8.onnx"
+            print(f" ** Quantizing to INT8 ({len(tiles)} calibration sub-images)...")
+            quantize_int8(args.model, out_path, tiles, args.per_channel)
+            print("INT8 model saved to:", os.path.abspath(out_path))
+            candidates.append(out_path)
+        if "fp16" in formats:
+            out_path = out_dir / f"{stem}_fp16.onnx"
+            convert_fp16(args.model, out_path)
+            print("FP16 model saved to:", os.path.abspath(out_path))
+            candidates.append(out_path)
+
+    print(" ** Comparing against the float32 model...")
+    report = compare_models(expdata, args.model, candidates, random_items(expdata, args.samples, args.seed),
+                            args.low, args.high, [p.strip() for p in args.providers.split(",") if p.strip()],
+                            args.threads, mask_opts=mask_opts, tolerance=args.tolerance)
+    if report is None:
+        print(herror + " No sample found in the compared images!")
+        exit()
+
+    print_report(report)
+    report_path = out_dir / f"{stem}_compare.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print("\nComparison report saved to:", os.path.abspath(report_path))
+    if not all(c["agree"] for c in report["candidates"]):
+        print(hwarning + f"Infected % differ by more than {args.tolerance} points on some samples, "
+              "check the disagreeing samples before using these models.")
@@ -0,0 +1,106 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sessions import INPUT_CHANNELS_KEY
+
+
+# Useful colored strings
+hwarning = "\033[93m[WARNING]\033[0m: "
+herror = "\033[91m[ERROR]\033[0m: "
+
+UINT8_INPUT_NAME = "input_uint8_nhwc"
+
+
+def wrap_uint8_input(model, bgr=False):
+    """
+        Prepends Transpose (NHWC to NCHW) and Cast (uint8 to float32) nodes to the model, so it takes a
+        uint8 N x H x W x C batch of sub-images as they are stored in the image, instead of the float32
+        N x C x H x W one. With bgr, a Gather node also swaps the channels, so the model takes BGR
+        sub-images (as decoded by OpenCV). The channel order is stored in the model metadata.
+    """
+    graph = model.graph
+    initializer_names = {init.name for init in graph.initializer}
+    inputs = [t for t in graph.input if t.name not in initializer_names]
+    if len(inputs) != 1:
+        raise ValueError("The model must have a single input")
+    old_input = inputs[0]
+    tensor_type = old_input.type.tensor_type
+    if tensor_type.elem_type != TensorProto.FLOAT or len(tensor_type.shape.dim) != 4:
+        raise ValueError("The model input is not a float32 N x C x H x W tensor (already wrapped?)")
+
+    n, c, h, w = [d.dim_param if d.dim_param else d.dim_value for d in tensor_type.shape.dim]
+    new_input = helper.make_tensor_value_info(UINT8_INPUT_NAME, TensorProto.UINT8, [n, h, w, c])
+
+    nodes = []
+    x = UINT8_INPUT_NAME
+    if bgr:
+        graph.initializer.append(numpy_helper.from_array(np.array([2, 1, 0], dtype=np.int64), "bgr_to_rgb"))
+        nodes.append(helper.make_node("Gather", [x, "bgr_to_rgb"], ["input_rgb_nhwc"], axis=3))
+        x = "input_rgb_nhwc"
+    # NOTE: Transposed before the cast, moving 1 byte per pixel instead of 4
+    nodes.append(helper.make_node("Transpose", [x], ["input_uint8_nchw"], perm=[0, 3, 1, 2]))
+    nodes.append(helper.make_node("Cast", ["input_uint8_nchw"], [old_input.name], to=TensorProto.FLOAT))
+
+    for i, node in enumerate(nodes):
+        graph.node.insert(i, node)
+    graph.input.remove(old_input)
+    graph.input.insert(0, new_input)
+
+    helper.set_model_props(model, dict({p.key: p.value for p in model.metadata_props},
+                                       **{INPUT_CHANNELS_KEY: "BGR" if bgr else "RGB"}))
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wraps an ONNX model to take uint8 NHWC sub-images")
+    parser.add_argument(
+        "model",
+        metavar="<ONNX_MODEL>",
+        help="Path to the float32 NCHW ONNX model",
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        metavar="<OUT_ONNX>",
+        required=False,
+        default=None,
+        help="Path of the wrapped model (default: <MODEL>_uint8.onnx, or <MODEL>_uint8_bgr.onnx with --bgr)",
+    )
+    parser.add_argument(
+        "--bgr",
+        action="store_true",
+        help="Swap the channels inside the model, so it takes BGR sub-images and the images are not converted to RGB",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(herror + " Specified model path " + args.model + " does not exist!")
+        exit()
+
+    try:
+        model = wrap_uint8_input(onnx.load(args.model), args.bgr)
+    except ValueError as e:
+        print(herror + " " + str(e) + "!")
+        exit()
+    onnx.checker.check_model(model)
+
+    out_path = args.out
+    if out_path is None:
+        out_path = os.path.splitext(args.model)[0] + ("_uint8_bgr.onnx" if args.bgr else "_uint8.onnx")
+    onnx.save(model, out_path)
+    print("Model with uint8 NHWC input saved to:", os.path.abspath(out_path))
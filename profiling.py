@@ -0,0 +1,237 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+# Analysis stages, in pipeline order
+PROFILE_STAGES = ["read", "cache", "decode", "color", "masking", "focus", "tiling", "inference", "persist"]
+PROFILE_PERCENTILES = [50, 90, 99]
+JSONL_EXT = ".jsonl"
+TRACE_EXT = ".trace.json"
+
+
+def memory_usage():
+    """
+        Returns (current, peak) resident memory of this process in bytes (working set in Windows).
+        Any of them is None if it can not be read on this platform.
+    """
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None, None
+        return counters.WorkingSetSize, counters.PeakWorkingSetSize
+
+    import resource
+    # NOTE: ru_maxrss is in KB, except in macOS (bytes)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        current = None
+    return current, peak
+
+
+class Profiler:
+    """
+        Thread-safe recorder of the analysis stage timings. Each stage run of a sample is recorded as
+        a span (sample, stage, pid, thread, start, end), and per sample values (tile counts, batch
+        sizes, wall time) as notes. Spans recorded in worker processes are added with merge().
+    """
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.notes = {}     # sample -> {name: value}, in the order samples are first seen
+        self.threads = {}   # (pid, tid) -> thread name
+        self._lock = threading.Lock()
+
+    def sample(self, key):
+        return SampleTrace(self, key)
+
+    def add_span(self, key, stage, start, end):
+        thread = threading.current_thread()
+        with self._lock:
+            self.spans.append((key, stage, os.getpid(), thread.ident, start, end))
+            self.threads.setdefault((os.getpid(), thread.ident), thread.name)
+            self.notes.setdefault(key, {})
+
+    def note(self, key, batch=None, **values):
+        with self._lock:
+            notes = self.notes.setdefault(key, {})
+            notes.update(values)
+            if batch is not None:
+                notes.setdefault("batches", []).append(batch)
+
+    def export(self):
+        # Recorded data as plain containers (ex: to be sent from a worker process)
+        return {"spans": self.spans, "notes": self.notes, "threads": self.threads}
+
+    def merge(self, data):
+        with self._lock:
+            self.spans.extend(data["spans"])
+            for key, notes in data["notes"].items():
+                self.notes.setdefault(key, {}).update(notes)
+            self.threads.update(data["threads"])
+
+    def records(self):
+        """
+            Returns one dict per sample: sample name, seconds spent in each stage (summed over the
+            threads and batches of the sample), start time (s since the profiler was created) and notes.
+        """
+        with self._lock:
+            spans = list(self.spans)
+            notes = {key: dict(n) for key, n in self.notes.items()}
+
+        stages = {key: {} for key in notes}
+        starts = {}
+        for key, stage, _, _, start, end in spans:
+            stages[key][stage] = stages[key].get(stage, 0) + end - start
+            starts[key] = min(starts.get(key, start), start)
+
+        records = []
+        for key, n in notes.items():
+            name = "/".join([n["date"], n["tray"], n["image"]]) if "image" in n else str(key)
+            records.append(dict({"sample": name,
+                                 "start_s": starts[key] - self.t0 if key in starts else None,
+                                 "stages": stages[key]}, **{k: v for k, v in n.items() if k != "image"}))
+        return records
+
+    def summary(self):
+        """
+            Percentiles (PROFILE_PERCENTILES) of the time per sample of each stage, and of the sample wall
+            time (time between consecutive samples of the analysis). Returns {stage: {count, total_s,
+            mean_ms, p<N>_ms..., max_ms}} plus the total tiles, in focus tiles and inference batches,
+            and the largest decoded image and peak resident memory of the processes (MB, None if unknown).
+        """
+        records = self.records()
+        values = {stage: [r["stages"][stage] for r in records if stage in r["stages"]] for stage in PROFILE_STAGES}
+        values["sample"] = [r["wall_s"] for r in records if "wall_s" in r]
+
+        summary = {}
+        for stage, times in values.items():
+            if len(times) == 0:
+                continue
+            times = np.array(times) * 1000
+            stats = {"count": len(times), "total_s": float(times.sum() / 1000), "mean_ms": float(times.mean())}
+            for p, v in zip(PROFILE_PERCENTILES, np.percentile(times, PROFILE_PERCENTILES)):
+                stats[f"p{p}_ms"] = float(v)
+            stats["max_ms"] = float(times.max())
+            summary[stage] = stats
+
+        batches = [b for r in records for b in r.get("batches", [])]
+        summary["tiles"] = sum(r.get("tiles", 0) for r in records)
+        summary["in_focus"] = sum(r.get("in_focus", 0) for r in records)
+        summary["batches"] = len(batches)
+        summary["mean_batch"] = float(np.mean(batches)) if len(batches) else 0.0
+        image_mb = [r["image_mb"] for r in records if r.get("image_mb") is not None]
+        peak_rss_mb = [r["peak_rss_mb"] for r in records if r.get("peak_rss_mb") is not None]
+        summary["max_image_mb"] = max(image_mb) if len(image_mb) else None
+        summary["peak_rss_mb"] = max(peak_rss_mb) if len(peak_rss_mb) else None
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        header = f"{'Stage':<10} {'Count':>7} {'Total (s)':>10} {'Mean':>9}" + \
+                 "".join(f" {'P'+str(p):>9}" for p in PROFILE_PERCENTILES) + f" {'Max':>9}   (ms per sample)"
+        print(header)
+        for stage in PROFILE_STAGES + ["sample"]:
+            if stage not in summary:
+                continue
+            s = summary[stage]
+            print(f"{stage:<10} {s['count']:7d} {s['total_s']:10.2f} {s['mean_ms']:9.2f}" +
+                  "".join(f" {s[f'p{p}_ms']:9.2f}" for p in PROFILE_PERCENTILES) + f" {s['max_ms']:9.2f}")
+        print(f"Sub-images: {summary['in_focus']}/{summary['tiles']} in focus, {summary['batches']} inference "
+              f"runs (mean batch {summary['mean_batch']:.1f})")
+        if summary["peak_rss_mb"] is not None:
+            print(f"Memory: {summary['peak_rss_mb']:.1f} MB peak resident (process), "
+                  f"{summary['max_image_mb'] or 0:.1f} MB largest decoded image")
+
+    def write_jsonl(self, path):
+        # One JSON object per sample (see records())
+        with open(path, "w") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+
+    def write_trace(self, path):
+        # Chrome trace event format (chrome://tracing, https://ui.perfetto.dev), one track per thread
+        with self._lock:
+            spans = list(self.spans)
+            notes = {key: dict(n) for key, n in self.notes.items()}
+            threads = dict(self.threads)
+
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for (pid, tid), name in threads.items()]
+        for key, stage, pid, tid, start, end in spans:
+            n = notes.get(key, {})
+            name = "/".join([n["date"], n["tray"], n["image"]]) if "image" in n else str(key)
+            events.append({"name": stage, "cat": "analysis", "ph": "X", "pid": pid, "tid": tid,
+                           "ts": (start - self.t0) * 1e6, "dur": (end - start) * 1e6, "args": {"sample": name}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def save(self, path):
+        # Writes <path>.jsonl and <path>.trace.json, returns their paths
+        path = str(path)
+        self.write_jsonl(path + JSONL_EXT)
+        self.write_trace(path + TRACE_EXT)
+        return path + JSONL_EXT, path + TRACE_EXT
+
+
+class SampleTrace:
+    # Profiler bound to one sample, passed down the analysis stages of the sample
+    def __init__(self, profiler, key):
+        self.profiler = profiler
+        self.key = key
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.profiler.add_span(self.key, stage, start, time.perf_counter())
+
+    def note(self, batch=None, **values):
+        self.profiler.note(self.key, batch, **values)
+
+    def note_memory(self):
+        # Resident memory of the process that analyzed the sample, once analyzed (see memory_usage())
+        current, peak = memory_usage()
+        self.note(rss_mb=current / 2**20 if current is not None else None,
+                  peak_rss_mb=peak / 2**20 if peak is not None else None)
+
+
+def span(trace, stage):
+    # Times the stage if the sample is being profiled (trace is a SampleTrace or None)
+    return nullcontext() if trace is None else trace.span(stage)
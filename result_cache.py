@@ -0,0 +1,94 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+import msgpack
+import msgpack_numpy as mnp
+mnp.patch()
+
+from sessions import MODEL_CACHE_DIR
+
+
+RESULT_CACHE_DIR = MODEL_CACHE_DIR / "results"
+RESULT_CACHE_FILENAME = "results_cache.sqlite"
+RESULT_CACHE_MAX_MB = 512
+NO_SAMPLE = False           # Cached value of the images where no sample is found (get() returns None if not cached)
+
+
+class ResultCache:
+    """
+        Persistent cache of sample score maps, keyed on the image file contents and on everything
+        else the score map depends on (model hash and analysis parameters, given as key_params).
+        Entries are stored in a SQLite database, which makes it safe to use from several threads
+        and processes at the same time, and the least recently used ones are evicted when the
+        cache grows over max_mb.
+    """
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, key_params=None, max_mb=RESULT_CACHE_MAX_MB):
+        self.path = Path(cache_dir) / RESULT_CACHE_FILENAME
+        self.max_bytes = int(max_mb * 2**20)
+        params = key_params if key_params is not None else {}
+        self._key_prefix = "|".join(f"{k}={params[k]}" for k in sorted(params)).encode()
+        self._local = threading.local()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                     "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access)")
+        conn.commit()
+
+    def _conn(self):
+        # One connection per thread (SQLite connections can't be shared between threads)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL") # Readers don't block writers
+            self._local.conn = conn
+        return conn
+
+    def key(self, image_bytes):
+        h = hashlib.sha256(self._key_prefix)
+        h.update(b"|")
+        h.update(image_bytes)
+        return h.hexdigest()
+
+    def get(self, key):
+        # Returns the cached score map (NO_SAMPLE if no sample was found in the image), or None
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return msgpack.unpackb(row[0])
+
+    def put(self, key, score_map):
+        value = msgpack.packb(score_map)
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                         (key, value, len(value), time.time()))
+            total = conn.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                # Evict least recently used entries until the cache fits in max_bytes
+                conn.execute("DELETE FROM entries WHERE key IN ("
+                             "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_access DESC) AS used "
+                             "FROM entries) WHERE used > ?)", (self.max_bytes,))
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,479 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+import zlib
+import struct
+import argparse
+from pathlib import Path
+from collections.abc import Mapping
+
+import numpy as np
+import msgpack
+import msgpack_numpy as mnp
+mnp.patch()
+
+
+# Useful colored strings
+hwarning = "\033[93m[WARNING]\033[0m: "
+herror = "\033[91m[ERROR]\033[0m: "
+
+RESULTS_FILENAME = "results.msgpack"
+CHECKPOINT_EXT = ".checkpoint"
+RESULTS_STORE_EXT = ".bbr"
+
+CHECKPOINT_VERSION = 1
+
+# Results store file: header, score maps arena (aligned) and msgpack index
+STORE_MAGIC = b"BBRSTORE"
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct("<8sIIQQ")  # magic, version, reserved, index offset, index size
+STORE_ARENA_OFFSET = 64
+STORE_DTYPE = np.float32
+
+# Compact score map encoding of msgpack results files (see encode_score_map())
+SCORE_ENCODINGS = ["float32", "float16", "uint8"]   # float32 = plain arrays, as by default
+SCORE_EXT_CODE = 1          # msgpack extension type of the encoded score maps
+SCORE_HEADER = struct.Struct("<BBII")   # encoding (index in SCORE_ENCODINGS), compressed, rows, cols
+SCORE_COMPRESS_LEVEL = 6    # zlib level of the compressed score maps
+
+
+def is_results_store(path):
+    return Path(path).suffix == RESULTS_STORE_EXT
+
+
+def check_store_encoding(encoding, compress):
+    # NOTE: Results stores are memory-mapped float32 score maps
+    if encoding != "float32" or compress:
+        raise ValueError("Results stores only support float32 uncompressed score maps")
+
+
+def results_layout(results):
+    # {date: {tray: n_slots}} of a results dict
+    return {d: {t: len(results[d][t]) for t in results[d]} for d in results}
+
+
+def encode_score_map(score_map, encoding="float16", compress=False):
+    """
+        Compact encoding of a score map as a msgpack extension type: shape, bit-packed focus mask
+        (sub-images with a score) and the scores of the focused sub-images only, as float16 or
+        quantized to uint8 (1/255 steps), optionally zlib-compressed (kept only if smaller).
+        Max. score error is 2^-12 (float16) or 1/510 (uint8), see decode_score_map().
+    """
+    score_map = np.asarray(score_map, dtype=np.float32)
+    if score_map.ndim != 2:
+        raise ValueError("Only 2D score maps can be encoded")
+    focus = ~np.isnan(score_map)
+    scores = score_map[focus]
+    if encoding == "uint8":
+        values = np.rint(np.clip(scores, 0, 1) * 255).astype(np.uint8)
+    elif encoding == "float16":
+        values = scores.astype("<f2")
+    else:
+        raise ValueError(f"Unknown score map encoding '{encoding}'")
+
+    payload = np.packbits(focus).tobytes() + values.tobytes()
+    compressed = False
+    if compress:
+        packed = zlib.compress(payload, SCORE_COMPRESS_LEVEL)
+        if len(packed) < len(payload):
+            payload, compressed = packed, True
+    header = SCORE_HEADER.pack(SCORE_ENCODINGS.index(encoding), compressed, *score_map.shape)
+    return msgpack.ExtType(SCORE_EXT_CODE, header + payload)
+
+
+def decode_score_map(code, data):
+    # msgpack ext_hook: score map encoded by encode_score_map() as a float32 array (NaN = not analyzed)
+    if code != SCORE_EXT_CODE:
+        return msgpack.ExtType(code, data)
+    encoding, compressed, rows, cols = SCORE_HEADER.unpack_from(data)
+    payload = data[SCORE_HEADER.size:]
+    if compressed:
+        payload = zlib.decompress(payload)
+
+    n_mask = (rows*cols + 7) // 8
+    focus = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, count=n_mask), count=rows*cols).astype(bool)
+    score_map = np.full(rows*cols, np.nan, dtype=np.float32)
+    if SCORE_ENCODINGS[encoding] == "uint8":
+        score_map[focus] = np.frombuffer(payload, dtype=np.uint8, offset=n_mask) / np.float32(255)
+    else:
+        score_map[focus] = np.frombuffer(payload, dtype="<f2", offset=n_mask)
+    return score_map.reshape(rows, cols)
+
+
+def encode_sample(sample, encoding="float32", compress=False):
+    # Sample result (None or (sample_id, score_map)) with its score map encoded, as written to results files
+    if sample is None or sample[1] is None or (encoding == "float32" and not compress):
+        return sample
+    if encoding == "float32":
+        raise ValueError("Compression requires the float16 or uint8 score map encoding")
+    return (sample[0], encode_score_map(sample[1], encoding, compress))
+
+
+def save_results(results, out_path, encoding="float32", compress=False):
+    """
+        Write results to msgpack file (or to a results store if out_path has its extension).
+        Score maps are stored as float32 arrays, or with the compact encoding (float16 or uint8,
+        optionally compressed, see encode_score_map()), only available in msgpack files.
+    """
+    if is_results_store(out_path):
+        check_store_encoding(encoding, compress)
+        write_results_store(((d, t, results[d][t]) for d in results for t in results[d]), out_path)
+        return
+    if encoding != "float32" or compress:
+        results = {d: {t: [encode_sample(s, encoding, compress) for s in results[d][t]] for t in results[d]} for d in results}
+    with open(out_path, "wb") as outfile:
+        packed = msgpack.packb(results)
+        outfile.write(packed)
+
+
+def load_results(res_path):
+    # Read msgpack file (or results store) into a results dict, compact score maps are decoded to float32
+    if is_results_store(res_path):
+        with ResultsStore(res_path) as store:
+            return store.to_dict()
+    with open(res_path, "rb") as data_file:
+        byte_data = data_file.read()
+    return msgpack.unpackb(byte_data, ext_hook=decode_score_map)
+
+
+def open_results(res_path):
+    """
+        Results of a msgpack file (loaded in memory) or of a results store (loaded lazily, each
+        tray is read from the file when accessed). Both are read as {date: {tray: [...]}}.
+    """
+    if is_results_store(res_path):
+        return ResultsStore(res_path)
+    return load_results(res_path)
+
+
+def iter_results_msgpack(res_path):
+    """
+        Streams the trays of a msgpack results file without loading it in memory. Yields
+        (date, tray, slots), where slots is a generator of its sample results that must be
+        consumed before moving to the next tray.
+    """
+    with open(res_path, "rb") as f:
+        unpacker = msgpack.Unpacker(f, use_list=False, ext_hook=decode_score_map)
+        for _ in range(unpacker.read_map_header()):
+            date = unpacker.unpack()
+            for _ in range(unpacker.read_map_header()):
+                tray = unpacker.unpack()
+                n_slots = unpacker.read_array_header()
+                yield date, tray, (unpacker.unpack() for _ in range(n_slots))
+
+
+def write_results_msgpack(layout, read_tray, out_path, encoding="float32", compress=False):
+    """
+        Writes a msgpack results file (same bytes as save_results()) one tray at a time.
+        layout: {date: {tray: n_slots}}, read_tray(date, tray): the sample results of the tray.
+    """
+    packer = msgpack.Packer()
+    with open(out_path, "wb") as outfile:
+        outfile.write(packer.pack_map_header(len(layout)))
+        for date in layout:
+            outfile.write(packer.pack(date))
+            outfile.write(packer.pack_map_header(len(layout[date])))
+            for tray in layout[date]:
+                outfile.write(packer.pack(tray))
+                outfile.write(packer.pack_array_header(layout[date][tray]))
+                for sample in read_tray(date, tray):
+                    outfile.write(packer.pack(encode_sample(sample, encoding, compress)))
+
+
+def write_results_store(trays, out_path):
+    """
+        Writes a results store: all score maps in a single contiguous float32 arena followed by a
+        columnar index (date, tray, slot, sample id, shape and arena offset of each sample).
+        trays: iterable of (date, tray, slots) in results order, slots being the tray sample results
+        (None or (sample_id, score_map)). Only one score map is held in memory at a time.
+    """
+    groups = []     # [date, tray, n_slots, first entry]
+    slot, sample_id, offset, rows, cols = [], [], [], [], []
+    with open(out_path, "wb") as outfile:
+        outfile.write(b"\0" * STORE_ARENA_OFFSET)
+        arena_len = 0
+        for date, tray, slots in trays:
+            group = [date, tray, 0, len(slot)]
+            for i, sample in enumerate(slots):
+                group[2] += 1
+                if sample is None:
+                    continue
+                slot.append(i)
+                sample_id.append(sample[0])
+                score_map = sample[1]
+                if score_map is None: # No sample detected
+                    offset.append(-1)
+                    rows.append(0)
+                    cols.append(0)
+                    continue
+                score_map = np.ascontiguousarray(score_map, dtype=STORE_DTYPE)
+                offset.append(arena_len)
+                rows.append(score_map.shape[0])
+                cols.append(score_map.shape[1])
+                outfile.write(score_map.tobytes())
+                arena_len += score_map.size
+            groups.append(group)
+
+        index = msgpack.packb({"dtype": np.dtype(STORE_DTYPE).str,
+                               "arena_len": arena_len,
+                               "groups": groups,
+                               "slot": np.array(slot, dtype=np.uint32),
+                               "sample_id": sample_id,
+                               "offset": np.array(offset, dtype=np.int64),
+                               "rows": np.array(rows, dtype=np.uint32),
+                               "cols": np.array(cols, dtype=np.uint32)})
+        index_offset = outfile.tell()
+        outfile.write(index)
+        outfile.seek(0)
+        outfile.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, 0, index_offset, len(index)))
+
+
+class ResultsStore(Mapping):
+    """
+        Read-only results store (see write_results_store()). Score maps are read-only views of a
+        memory-mapped arena, so only the trays or timepoints accessed are read from disk.
+        Behaves as the results dict: store[date][tray] is the list of sample results of the tray.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            magic, version, _, index_offset, index_size = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+            if magic != STORE_MAGIC or version != STORE_VERSION:
+                raise ValueError(f"'{self.path}' is not a results store (or it was written by another version)")
+            f.seek(index_offset)
+            index = msgpack.unpackb(f.read(index_size))
+
+        self._index = index
+        self._groups = {}
+        for n, (date, tray, n_slots, first) in enumerate(index["groups"]):
+            last = index["groups"][n+1][3] if n+1 < len(index["groups"]) else len(index["slot"])
+            self._groups.setdefault(date, {})[tray] = (n_slots, first, last)
+
+        self._arena = None
+        if index["arena_len"] > 0:
+            self._arena = np.memmap(self.path, dtype=np.dtype(index["dtype"]), mode="r",
+                                    offset=STORE_ARENA_OFFSET, shape=(index["arena_len"],))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, date):
+        if date not in self._groups:
+            raise KeyError(date)
+        return _StoreTimepoint(self, date)
+
+    def __iter__(self):
+        return iter(self._groups)
+
+    def __len__(self):
+        return len(self._groups)
+
+    def layout(self):
+        # {date: {tray: n_slots}}
+        return {d: {t: self._groups[d][t][0] for t in self._groups[d]} for d in self._groups}
+
+    def tray(self, date, tray):
+        # Sample results of one tray: [None or (sample_id, score_map), ...]
+        n_slots, first, last = self._groups[date][tray]
+        idx = self._index
+        samples = [None] * n_slots
+        for e in range(first, last):
+            score_map = None
+            if idx["offset"][e] >= 0:
+                start = int(idx["offset"][e])
+                shape = (int(idx["rows"][e]), int(idx["cols"][e]))
+                score_map = self._arena[start:start + shape[0]*shape[1]].reshape(shape)
+            samples[idx["slot"][e]] = (idx["sample_id"][e], score_map)
+        return samples
+
+    def to_dict(self):
+        # Whole results dict, score maps copied in memory
+        return {d: {t: [None if s is None else (s[0], None if s[1] is None else np.array(s[1]))
+                        for s in self.tray(d, t)]
+                    for t in self._groups[d]}
+                for d in self._groups}
+
+    def close(self):
+        # NOTE: The file is unmapped when the score maps still in use are released
+        self._arena = None
+
+
+class _StoreTimepoint(Mapping):
+    # Trays of one timepoint of a ResultsStore, read when accessed
+    def __init__(self, store, date):
+        self._store = store
+        self._date = date
+
+    def __getitem__(self, tray):
+        if tray not in self._store._groups[self._date]:
+            raise KeyError(tray)
+        return self._store.tray(self._date, tray)
+
+    def __iter__(self):
+        return iter(self._store._groups[self._date])
+
+    def __len__(self):
+        return len(self._store._groups[self._date])
+
+
+def convert_results(in_path, out_path, encoding="float32", compress=False):
+    """
+        Converts between msgpack results files and results stores, one tray at a time, or re-encodes
+        the score maps of a msgpack results file (ex: to the compact encoding, see save_results()).
+    """
+    if is_results_store(in_path) and is_results_store(out_path):
+        raise ValueError("Input and output results can't be both results stores")
+    if is_results_store(out_path):
+        check_store_encoding(encoding, compress)
+        write_results_store(iter_results_msgpack(in_path), out_path)
+    elif is_results_store(in_path):
+        with ResultsStore(in_path) as store:
+            write_results_msgpack(store.layout(), store.tray, out_path, encoding, compress)
+    else:
+        save_results(load_results(in_path), out_path, encoding, compress)
+
+
+def checkpoint_path(out_path):
+    return Path(out_path).with_suffix(CHECKPOINT_EXT)
+
+
+def model_results_path(out_path, model_path):
+    # Results file of one of the models of a multi-model analysis (ex: results_SporeNet3.msgpack)
+    out_path = Path(out_path)
+    return out_path.with_name(f"{out_path.stem}_{Path(model_path).stem}{out_path.suffix}")
+
+
+class Checkpoint:
+    """
+        Append-only analysis checkpoint file. The first record is a header identifying the analysis
+        (model hash and analysis parameters), followed by one [date, tray, sample_idx, sample_id, score_map] record per
+        analyzed sample, written (and flushed) as soon as the sample is scored.
+    """
+    def __init__(self, path, header):
+        self.path = Path(path)
+        self.done = {}  # (date, tray, sample_idx) -> file offset of the record
+        self._file = None
+
+        header = dict(header, version=CHECKPOINT_VERSION)
+        end_offset = 0
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                unpacker = msgpack.Unpacker(f)
+                try:
+                    if next(unpacker, None) != header:
+                        print(hwarning+"Checkpoint '"+str(self.path)+"' belongs to another analysis, discarded.")
+                    else:
+                        end_offset = unpacker.tell()
+                        for date, tray, sample_idx, _, _ in unpacker:
+                            self.done[(date, tray, sample_idx)] = end_offset
+                            end_offset = unpacker.tell()
+                except Exception: # Corrupted record, keep what was read before it
+                    print(hwarning+"Checkpoint '"+str(self.path)+"' is damaged, last samples will be analyzed again.")
+
+        self._file = open(self.path, "r+b" if end_offset > 0 else "wb")
+        # Drop any partially written record (ex: process killed while writing)
+        self._file.truncate(end_offset)
+        self._file.seek(end_offset)
+        if end_offset == 0:
+            self._file.write(msgpack.packb(header))
+            self._file.flush()
+
+    def is_done(self, date, tray, sample_idx):
+        return (date, tray, sample_idx) in self.done
+
+    def append(self, date, tray, sample_idx, sample_id, score_map):
+        offset = self._file.tell()
+        self._file.write(msgpack.packb([date, tray, sample_idx, sample_id, score_map]))
+        self._file.flush()
+        self.done[(date, tray, sample_idx)] = offset
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write_results(self, expdata, out_path, encoding="float32", compress=False):
+        """
+            Writes the final results file (same format as save_results(), with the given score map
+            encoding) from the checkpoint records, reading one score map at a time.
+        """
+        self._file.flush()
+        layout = results_layout(expdata["samples"])
+        with open(self.path, "rb") as ckpt:
+            def read_tray(date, tray):
+                for sample_idx in range(layout[date][tray]):
+                    offset = self.done.get((date, tray, sample_idx))
+                    if offset is None:
+                        yield None
+                        continue
+                    ckpt.seek(offset)
+                    _, _, _, sample_id, score_map = next(msgpack.Unpacker(ckpt))
+                    # Store result tuple of (sample_id_str, score_map)
+                    yield (sample_id, score_map)
+
+            if is_results_store(out_path):
+                check_store_encoding(encoding, compress)
+                write_results_store(((d, t, read_tray(d, t)) for d in layout for t in layout[d]), out_path)
+            else:
+                write_results_msgpack(layout, read_tray, out_path, encoding, compress)
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Blackbird Results Converter")
+    parser.add_argument(
+        "in_path",
+        metavar="<IN_PATH>",
+        help="Results file to convert (*.msgpack or *" + RESULTS_STORE_EXT + " results store)",
+    )
+    parser.add_argument(
+        "out_path",
+        metavar="<OUT_PATH>",
+        help="Converted results file, in the other format (or a *.msgpack file to re-encode the score maps)",
+    )
+    parser.add_argument(
+        "-e",
+        "--score-encoding",
+        choices=SCORE_ENCODINGS,
+        default="float32",
+        help="Score map encoding of the converted *.msgpack file (float16: max. error 2^-12, uint8: 1/255 steps, max. error 1/510)",
+    )
+    parser.add_argument(
+        "-z",
+        "--compress",
+        action="store_true",
+        help="zlib-compress the float16/uint8 score maps",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.in_path):
+        print(herror + " Specified results path '" + args.in_path + "' does not exist!")
+        exit()
+
+    if is_results_store(args.in_path) and is_results_store(args.out_path):
+        print(herror + " Input and output can't be both *" + RESULTS_STORE_EXT + " results stores!")
+        exit()
+
+    if (args.score_encoding != "float32" or args.compress) and is_results_store(args.out_path):
+        print(herror + " The compact score map encoding is only available in *.msgpack files!")
+        exit()
+
+    if args.compress and args.score_encoding == "float32":
+        print(herror + " Compression requires the float16 or uint8 score map encoding!")
+        exit()
+
+    convert_results(args.in_path, args.out_path, args.score_encoding, args.compress)
+    print("Converted results saved to:", os.path.abspath(args.out_path))
@@ -0,0 +1,194 @@
+__author__ = "Dani Martinez"
+__copyright__ = "Copyright 2025, Moblanc Robotics & Cornell University"
+__credits__ = ["Dani Martinez"]
+__license__ = "Apache 2.0"
+__version__ = "0.5"
+__maintainer__ = "Dani Martinez"
+__email__ = "dani.martinez@moblancrobotics.com"
+__status__ = "Production"
+
+import os
+import json
+import hashlib
+import platform
+from pathlib import Path
+
+import numpy as np
+
+# NOTE: onnxruntime is imported only when a session is created
+
+
+# Useful colored strings
+hwarning = "\033[93m[WARNING]\033[0m: "
+herror = "\033[91m[ERROR]\033[0m: "
+
+CPU_BACKEND = "CPUExecutionProvider"
+GPU_BACKEND = "DmlExecutionProvider"
+
+DEFAULT_PROVIDERS = [GPU_BACKEND, CPU_BACKEND]
+
+# Optimized models and probed infected indexes are stored here (set to None to disable caching)
+MODEL_CACHE_DIR = Path.home() / ".cache" / "blackbird"
+
+EXECUTION_MODES = ["sequential", "parallel"]
+OPT_LEVELS = ["disable", "basic", "extended", "all"]
+
+# Metadata of the models taking uint8 NHWC sub-images (see models/onnx_uint8_input.py): channel order
+INPUT_CHANNELS_KEY = "blackbird_input_channels"
+
+_model_hashes = {}
+
+
+def model_hash(model_path):
+    # SHA-256 of the model file, computed once per process for each model file version
+    st = os.stat(model_path)
+    key = (os.path.abspath(model_path), st.st_size, st.st_mtime_ns)
+    if key not in _model_hashes:
+        h = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _model_hashes[key] = h.hexdigest()
+    return _model_hashes[key]
+
+
+def resolve_providers(providers=None):
+    """
+        Returns the given execution providers (in order of preference) that are available in this
+        ONNX Runtime installation, always ending with the CPU provider as fallback.
+    """
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    resolved = []
+    for p in (providers if providers else DEFAULT_PROVIDERS):
+        if p not in available:
+            print(hwarning+f"Execution provider '{p}' is not available, skipped.")
+        elif p not in resolved:
+            resolved.append(p)
+
+    if CPU_BACKEND in resolved:
+        resolved.remove(CPU_BACKEND)
+    resolved.append(CPU_BACKEND)
+    return resolved
+
+
+def _write_atomic(path, data):
+    # Concurrent writers (ex: worker processes) never leave a partially written file behind
+    tmp_path = str(path) + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def create_session(model_path,
+                   providers=None,
+                   threads=0,
+                   inter_threads=0,
+                   execution_mode="sequential",
+                   opt_level="all",
+                   cache_dir=MODEL_CACHE_DIR
+):
+    """
+        Creates an ONNX Runtime inference session.
+            - providers: execution providers in order of preference, unavailable ones are skipped and
+              the CPU provider is always used as last fallback (also if the session creation fails)
+            - threads, inter_threads: intra-op and inter-op threads (0 = ONNX Runtime default)
+            - execution_mode: "sequential" or "parallel"
+            - opt_level: graph optimization level ("disable", "basic", "extended" or "all")
+            - cache_dir: folder where the optimized graph is stored, keyed on the model file hash, ONNX
+              Runtime version, providers, optimization level and machine, so later sessions skip the
+              graph optimization (None = no cache)
+    """
+    import onnxruntime as ort
+
+    opt_levels = {"disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                  "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                  "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                  "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL}
+    exec_modes = {"sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+                  "parallel": ort.ExecutionMode.ORT_PARALLEL}
+
+    providers = resolve_providers(providers)
+
+    def session_options(level):
+        opts = ort.SessionOptions()
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        if inter_threads > 0:
+            opts.inter_op_num_threads = inter_threads
+        opts.execution_mode = exec_modes[execution_mode]
+        opts.graph_optimization_level = opt_levels[level]
+        return opts
+
+    def new_session(session_providers):
+        if cache_dir is None or opt_level == "disable":
+            return ort.InferenceSession(model_path, sess_options=session_options(opt_level), providers=session_providers)
+
+        # NOTE: Optimized graphs may contain hardware specific optimizations, so the machine is part of the key
+        key = "|".join([model_hash(model_path), ort.__version__, opt_level, platform.node(), platform.machine()] + session_providers)
+        key = hashlib.sha256(key.encode()).hexdigest()
+        cached_path = Path(cache_dir) / (key[:32] + ".onnx")
+        if cached_path.exists():
+            # Already optimized graph, no need to optimize it again
+            return ort.InferenceSession(str(cached_path), sess_options=session_options("disable"), providers=session_providers)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = str(cached_path) + f".{os.getpid()}.tmp"
+        opts = session_options(opt_level)
+        opts.optimized_model_filepath = tmp_path
+        try:
+            sess = ort.InferenceSession(model_path, sess_options=opts, providers=session_providers)
+            os.replace(tmp_path, cached_path)
+            return sess
+        except Exception:
+            # NOTE: Some providers (ex: DirectML) can't serialize their optimized graphs
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return ort.InferenceSession(model_path, sess_options=session_options(opt_level), providers=session_providers)
+
+    try:
+        return new_session(providers)
+    except Exception as e:
+        if providers == [CPU_BACKEND]:
+            raise
+        print(hwarning+f"Session could not be created with {providers} ({e}), falling back to {CPU_BACKEND}.")
+        return new_session([CPU_BACKEND])
+
+
+def input_format(sess):
+    """
+        Returns (nhwc_uint8, channels) for the input of the model session: (False, "RGB") for the float32
+        NCHW models, (True, "RGB" or "BGR") for the models wrapped by models/onnx_uint8_input.py, which
+        take uint8 sub-images as they are stored in the image.
+    """
+    if sess.get_inputs()[0].type != "tensor(uint8)":
+        return False, "RGB"
+    return True, sess.get_modelmeta().custom_metadata_map.get(INPUT_CHANNELS_KEY, "RGB")
+
+
+def find_infected_index(sess, model_path=None, cache_dir=MODEL_CACHE_DIR):
+    """
+        Returns which score in the output tensor is the infected label. The result is cached by
+        model file hash when model_path and cache_dir are given.
+    """
+    cache_path = None
+    if model_path is not None and cache_dir is not None:
+        cache_path = Path(cache_dir) / (model_hash(model_path)[:32] + ".json")
+        if cache_path.exists():
+            with open(cache_path, "r") as f:
+                return json.load(f)["infected_prob_idx"]
+
+    # NOTE: TEMPORARY SOLUTION!!!
+    # Find out which score in output tensor is the infected label!
+    # Run a black image and take lowest prob as "Infected"
+    im_black = np.zeros([1,3,224,224],dtype=np.float32)
+    if input_format(sess)[0]:
+        im_black = np.zeros([1,224,224,3],dtype=np.uint8)
+    pred = sess.run([sess.get_outputs()[0].name], {sess.get_inputs()[0].name: im_black})[0][0]
+    infected_prob_idx = int(np.argmin(pred))
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_atomic(cache_path, json.dumps({"infected_prob_idx": infected_prob_idx}).encode())
+    return infected_prob_idx
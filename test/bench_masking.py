@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from engine import MASKING_RL_TH
+from masking import native_available, get_process
+
+
+def synthetic_sample(height, width, seed=0):
+    # Smooth leaf disc with a few textured lesions over a textured background
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    yy, xx = np.mgrid[:height, :width]
+    leaf = ((yy - height/2) / (height*0.4))**2 + ((xx - width/2) / (width*0.35))**2 < 1
+    img[leaf] = np.clip(np.array([40, 140, 50]) + rng.normal(0, 3, (np.count_nonzero(leaf), 3)), 0, 255)
+    for _ in range(5):
+        cy, cx = rng.integers(height//4, 3*height//4), rng.integers(width//4, 3*width//4)
+        spot = (yy - cy)**2 + (xx - cx)**2 < (min(height, width) * 0.03)**2
+        img[spot] = rng.integers(0, 256, (np.count_nonzero(spot), 3), dtype=np.uint8)
+    return img
+
+
+def measure(name, func, img, repeat):
+    mask = func(img, MASKING_RL_TH) # Warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(img, MASKING_RL_TH)
+        times.append(time.perf_counter() - start)
+
+    mpix = img.shape[0] * img.shape[1] / 1e6
+    print(f"{name:<10} {img.shape[1]:>6}x{img.shape[0]:<6} {min(times)*1000:10.1f} ms {mpix/min(times):10.1f} MP/s")
+    return mask
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Leaf masking throughput benchmark")
+    parser.add_argument("-i", "--image", metavar="<IMG_PATH>", default=None, required=False,
+                        help="Sample image to stack (default: synthetic sample)")
+    parser.add_argument("--height", metavar="<PX>", default=2448, type=int, required=False,
+                        help="Synthetic sample image height")
+    parser.add_argument("--width", metavar="<PX>", default=3264, type=int, required=False,
+                        help="Synthetic sample image width")
+    parser.add_argument("-s", "--stack", metavar="<N>", default=[1, 2, 4], type=int, nargs="+", required=False,
+                        help="Number of copies of the sample stacked per side")
+    parser.add_argument("-r", "--repeat", metavar="<N>", default=3, type=int, required=False,
+                        help="Number of timed repetitions")
+    args = parser.parse_args()
+
+    if args.image is not None:
+        base = cv2.cvtColor(cv2.imread(args.image, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    else:
+        base = synthetic_sample(args.height, args.width)
+
+    backends = ["numpy"] + (["native"] if native_available() else [])
+    if not native_available():
+        print("Native leaf masking module not available, only the NumPy/OpenCV backend is measured")
+
+    print(f"{'Backend':<10} {'Image':>13} {'Time (best)':>13} {'Throughput':>15}")
+    for n in args.stack:
+        img = np.ascontiguousarray(np.tile(base, (n, n, 1)))
+        masks = {backend: measure(backend, get_process(backend), img, args.repeat) for backend in backends}
+        if len(masks) > 1:
+            a, b = masks["numpy"], masks["native"]
+            if a is None or b is None:
+                print(f"{'':<10} Sample found: numpy {a is not None}, native {b is not None}")
+            else:
+                print(f"{'':<10} Mask pixels matching the native backend: {np.mean(a == b)*100:.3f}%")
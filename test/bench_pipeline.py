@@ -0,0 +1,302 @@
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from engine import MASKING_RL_TH, SUBIMAGE_HEIGHT, SUBIMAGE_WIDTH, BATCH_SIZE, DECODE_WORKERS
+from engine import get_expdata, iter_samples, empty_results, read_file, read_image, focus_grid, tile_view, get_batch_buffer
+from engine import load_model, analyze_experiment
+from masking import MASKING_BACKENDS, resolve_backend, get_process
+from sessions import input_format
+from results_io import RESULTS_FILENAME, Checkpoint, checkpoint_path
+from thresholder import write_xlsx
+from make_experiment import make_experiment
+
+
+STAGES = ["decode", "color", "masking", "focus", "tiling", "inference", "persistence", "thresholder"]
+REPORT_FILENAME = "bench_report.json"
+
+
+def synthetic_model(path, seed=0):
+    # Small CNN with the input/output of the Blackbird models (N x 3 x 224 x 224 -> N x 2 softmax)
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.default_rng(seed)
+    weights = [numpy_helper.from_array((rng.standard_normal((16, 3, 7, 7))*0.01).astype(np.float32), "conv_w"),
+               numpy_helper.from_array((rng.standard_normal((16, 16, 3, 3))*0.05).astype(np.float32), "conv2_w"),
+               numpy_helper.from_array(rng.standard_normal((16, 2)).astype(np.float32), "fc_w")]
+    nodes = [helper.make_node("Conv", ["input", "conv_w"], ["c1"], strides=[4, 4]),
+             helper.make_node("Relu", ["c1"], ["r1"]),
+             helper.make_node("Conv", ["r1", "conv2_w"], ["c2"], strides=[2, 2]),
+             helper.make_node("Relu", ["c2"], ["r2"]),
+             helper.make_node("GlobalAveragePool", ["r2"], ["pool"]),
+             helper.make_node("Flatten", ["pool"], ["flat"]),
+             helper.make_node("MatMul", ["flat", "fc_w"], ["fc"]),
+             helper.make_node("Softmax", ["fc"], ["prob"], axis=1)]
+    graph = helper.make_graph(nodes, "synthetic",
+                              [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", 3, SUBIMAGE_HEIGHT, SUBIMAGE_WIDTH])],
+                              [helper.make_tensor_value_info("prob", TensorProto.FLOAT, ["N", 2])], weights)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+def stage_stats(times, n_images):
+    times = np.array(times) if len(times) else np.zeros(1)
+    return {"total_s": float(times.sum()),
+            "per_image_ms": float(times.sum() / max(n_images, 1) * 1000),
+            "mean_ms": float(times.mean() * 1000),
+            "median_ms": float(np.median(times) * 1000),
+            "p90_ms": float(np.percentile(times, 90) * 1000),
+            "calls": int(len(times))}
+
+
+def bench_stages(expdata, model_path, providers, threads, batch_size, masking, work_dir):
+    """
+        Runs the analysis steps of every sample one after the other (same steps as
+        engine.prepare_sample() and engine.score_sample_models()), timing each of them.
+        Returns ({stage: [seconds, ...]}, n_images, n_subimages).
+    """
+    times = {stage: [] for stage in STAGES}
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        out = func(*args)
+        times[stage].append(time.perf_counter() - start)
+        return out
+
+    sess, out_pos, batch_size = load_model(model_path, providers, threads, batch_size, {"cache_dir": None})
+    in_name, out_name = sess.get_inputs()[0].name, sess.get_outputs()[0].name
+    nhwc, channels = input_format(sess) # Models wrapped by models/onnx_uint8_input.py take uint8 sub-images
+    process = get_process(masking)
+    results = empty_results(expdata)
+    batch_buffer = [None]
+
+    n_images = 0
+    n_subimages = 0
+    for date, tray, sample_idx, sample in iter_samples(expdata):
+        img_path = Path(expdata["path"]) / date / tray / sample
+        img = timed("decode", lambda: cv2.imdecode(read_file(img_path), cv2.IMREAD_UNCHANGED))
+        if channels == "RGB":
+            img = timed("color", cv2.cvtColor, img, cv2.COLOR_BGR2RGB, img)
+        imask = timed("masking", process, img, MASKING_RL_TH)
+        n_images += 1
+        if imask is None:
+            results[date][tray][sample_idx] = (os.path.splitext(sample)[0], None)
+            continue
+
+        im_h, im_w = img.shape[:2]
+        n_xsteps, n_ysteps = im_w // SUBIMAGE_WIDTH, im_h // SUBIMAGE_HEIGHT
+        xi, yi = (im_w % SUBIMAGE_WIDTH) // 2, (im_h % SUBIMAGE_HEIGHT) // 2
+        on_focus = timed("focus", focus_grid, imask, xi, yi, n_xsteps, n_ysteps)
+
+        score_map = np.full((n_ysteps, n_xsteps), np.nan, dtype=np.float32)
+        focus_i, focus_j = np.nonzero(on_focus)
+        n_batch = batch_size if batch_size > 0 else max(len(focus_i), 1)
+        t_tiling = 0
+        t_inference = 0
+        start = time.perf_counter()
+        tiles = tile_view(img, xi, yi, n_xsteps, n_ysteps)
+        for b in range(0, len(focus_i), n_batch):
+            chunk_i, chunk_j = focus_i[b:b+n_batch], focus_j[b:b+n_batch]
+            if nhwc:
+                batch = tiles[chunk_i, chunk_j]
+            else:
+                batch = get_batch_buffer(batch_buffer, len(chunk_i))
+                for n, (i, j) in enumerate(zip(chunk_i, chunk_j)):
+                    np.copyto(batch[n], tiles[i, j].transpose(2, 0, 1), casting="unsafe")
+            t_tiling += time.perf_counter() - start
+
+            start = time.perf_counter()
+            preds = sess.run([out_name], {in_name: batch})[0]
+            score_map[chunk_i, chunk_j] = preds[:, out_pos]
+            t_inference += time.perf_counter() - start
+            start = time.perf_counter()
+        times["tiling"].append(t_tiling)
+        times["inference"].append(t_inference)
+        n_subimages += len(focus_i)
+        results[date][tray][sample_idx] = (os.path.splitext(sample)[0], score_map)
+
+    # Persistence as done by the engine: checkpoint records, then the results file built from them
+    def persist():
+        out_path = Path(work_dir) / RESULTS_FILENAME
+        ckpt = Checkpoint(checkpoint_path(out_path), {"model": "bench"})
+        for date, tray, sample_idx, _ in iter_samples(expdata):
+            sample_id, score_map = results[date][tray][sample_idx]
+            ckpt.append(date, tray, sample_idx, sample_id, score_map)
+        ckpt.write_results(expdata, out_path)
+        ckpt.remove()
+    timed("persistence", persist)
+
+    with contextlib.redirect_stdout(io.StringIO()): # Thresholder progress lines
+        timed("thresholder", write_xlsx, results, 0.5, 0.5, Path(work_dir) / "results.xlsx")
+
+    return times, n_images, n_subimages
+
+
+def bench_end_to_end(expdir, model_path, providers, threads, batch_size, masking, workers, processes, work_dir):
+    # Wall time of a whole engine analysis (overlapped decoding, checkpointing and results file)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        analyze_experiment(expdir, model_path, providers=providers, threads=threads,
+                           session_opts={"cache_dir": None}, masking=masking, batch_size=batch_size,
+                           workers=workers, processes=processes, out_path=Path(work_dir) / "e2e.msgpack",
+                           checkpoint=True)
+    return time.perf_counter() - start
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare_reports(old, new, tolerance):
+    # Prints the per image time of each stage in both reports, returns the stages slower than tolerance
+    regressions = []
+    print(f"\n{'Stage':<14} {'Baseline':>12} {'Current':>12} {'Change':>9}   (ms/image, baseline {old.get('commit')})")
+    rows = [(s, old["stages"].get(s, {}).get("per_image_ms"), new["stages"][s]["per_image_ms"]) for s in STAGES]
+    rows.append(("end_to_end", old.get("end_to_end", {}).get("per_image_ms"), new["end_to_end"]["per_image_ms"]))
+    for stage, a, b in rows:
+        if a is None or a <= 0:
+            print(f"{stage:<14} {'-':>12} {b:12.2f}")
+            continue
+        change = b / a - 1
+        flag = "  REGRESSION" if change > tolerance else ""
+        print(f"{stage:<14} {a:12.2f} {b:12.2f} {change*100:+8.1f}%{flag}")
+        if flag:
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end analysis benchmark, timing each stage of the pipeline")
+    parser.add_argument("expdir", metavar="<EXP_DIR>", nargs="?", default=None,
+                        help="Experiment folder (default: synthetic experiment, see make_experiment.py)")
+    parser.add_argument("-m", "--model", metavar="<ONNX_MODEL>", default=None, required=False,
+                        help="ONNX model (default: small synthetic CNN, inference times are only "
+                             "representative with the real models)")
+    parser.add_argument("-p", "--providers", metavar="<PROVIDERS>", default="CPUExecutionProvider", required=False,
+                        help="Comma-separated list of ONNX Runtime execution providers")
+    parser.add_argument("-t", "--threads", metavar="<N_THREADS>", default=0, type=int, required=False,
+                        help="Intra-op inference threads (0 = ONNX Runtime default)")
+    parser.add_argument("-b", "--batch", metavar="<BATCH_SIZE>", default=BATCH_SIZE, type=int, required=False,
+                        help="Sub-images per inference run")
+    parser.add_argument("-w", "--workers", metavar="<N_WORKERS>", default=DECODE_WORKERS, type=int, required=False,
+                        help="Decoding threads of the end-to-end run")
+    parser.add_argument("-j", "--processes", metavar="<N_PROCESSES>", default=1, type=int, required=False,
+                        help="Worker processes of the end-to-end run")
+    parser.add_argument("--masking", choices=MASKING_BACKENDS, default="auto", required=False,
+                        help="Leaf masking implementation")
+    parser.add_argument("-d", "--dates", metavar="<N>", default=1, type=int, required=False,
+                        help="Synthetic experiment: number of timepoints")
+    parser.add_argument("--trays", metavar="<N>", default=1, type=int, required=False,
+                        help="Synthetic experiment: trays per timepoint")
+    parser.add_argument("-n", "--samples", metavar="<N>", default=8, type=int, required=False,
+                        help="Synthetic experiment: samples per tray")
+    parser.add_argument("--height", metavar="<PX>", default=2448, type=int, required=False,
+                        help="Synthetic experiment: image height")
+    parser.add_argument("--width", metavar="<PX>", default=3264, type=int, required=False,
+                        help="Synthetic experiment: image width")
+    parser.add_argument("-c", "--coverage", metavar="<RATIO>", default=0.45, type=float, required=False,
+                        help="Synthetic experiment: fraction of the image covered by the leaf")
+    parser.add_argument("--no-end-to-end", action="store_true",
+                        help="Only time the stages, skip the whole engine analysis run")
+    parser.add_argument("-o", "--out", metavar="<OUT_JSON>", default=REPORT_FILENAME, required=False,
+                        help="Path of the JSON report")
+    parser.add_argument("--label", metavar="<LABEL>", default=None, required=False,
+                        help="Free text stored in the report (ex: machine or branch name)")
+    parser.add_argument("--compare", metavar="<BASELINE_JSON>", default=None, required=False,
+                        help="Report of a previous run to compare with (exit status 1 on regressions)")
+    parser.add_argument("--tolerance", metavar="<RATIO>", default=0.1, type=float, required=False,
+                        help="Per image time increase over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    providers = [p.strip() for p in args.providers.split(",") if p.strip()]
+    masking = resolve_backend(args.masking)
+
+    with tempfile.TemporaryDirectory(prefix="bb_bench_") as work_dir:
+        expdir = args.expdir
+        if expdir is None:
+            expdir = os.path.join(work_dir, "experiment")
+            print(" ** Generating synthetic experiment...")
+            make_experiment(expdir, args.dates, args.trays, args.samples, args.height, args.width, args.coverage)
+
+        model_path = args.model
+        if model_path is None:
+            model_path = os.path.join(work_dir, "synthetic.onnx")
+            synthetic_model(model_path)
+
+        expdata = get_expdata(expdir)
+        if expdata is None:
+            sys.exit(1)
+
+        print(f" ** Timing stages on {expdata['nimages']} images...")
+        times, n_images, n_subimages = bench_stages(expdata, model_path, providers, args.threads, args.batch,
+                                                    masking, work_dir)
+        stages = {stage: stage_stats(times[stage], n_images) for stage in STAGES}
+
+        end_to_end = None
+        if not args.no_end_to_end:
+            print(" ** Timing end-to-end analysis...")
+            t = bench_end_to_end(expdir, model_path, providers, args.threads, args.batch, masking, args.workers,
+                                 args.processes, work_dir)
+            end_to_end = {"total_s": t, "per_image_ms": t / max(n_images, 1) * 1000,
+                          "images_per_s": n_images / t if t > 0 else None}
+
+        date, tray, _, sample = next(iter_samples(expdata))
+        first = read_image(Path(expdir) / date / tray / sample)
+
+    import onnxruntime as ort
+    report = {
+        "label": args.label,
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(),
+                    "cpu_count": os.cpu_count(), "python": platform.python_version()},
+        "versions": {"numpy": np.__version__, "opencv": cv2.__version__, "onnxruntime": ort.__version__},
+        "config": {"experiment": args.expdir if args.expdir is not None else "synthetic",
+                   "model": args.model if args.model is not None else "synthetic",
+                   "providers": providers, "threads": args.threads, "batch_size": args.batch,
+                   "workers": args.workers, "processes": args.processes, "masking": masking,
+                   "image_size": list(first.shape[:2]) if first is not None else None},
+        "n_images": n_images,
+        "n_subimages": n_subimages,
+        "stages": stages,
+        "end_to_end": end_to_end,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\n{'Stage':<14} {'Total (s)':>10} {'ms/image':>10} {'Median (ms)':>12} {'P90 (ms)':>10}")
+    for stage in STAGES:
+        s = stages[stage]
+        print(f"{stage:<14} {s['total_s']:10.2f} {s['per_image_ms']:10.2f} {s['median_ms']:12.2f} {s['p90_ms']:10.2f}")
+    if end_to_end is not None:
+        print(f"{'end_to_end':<14} {end_to_end['total_s']:10.2f} {end_to_end['per_image_ms']:10.2f}"
+              f"   ({end_to_end['images_per_s']:.2f} images/s)")
+    print(f"\n{n_images} images, {n_subimages} sub-images analyzed. Report saved to: {os.path.abspath(args.out)}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if end_to_end is None:
+            report["end_to_end"] = {"per_image_ms": 0}
+        if compare_reports(baseline, report, args.tolerance):
+            sys.exit(1)
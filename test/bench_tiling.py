@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from engine import SUBIMAGE_HEIGHT, SUBIMAGE_WIDTH, tile_view, get_batch_buffer
+
+
+def legacy_tiles(img, on_focus, xi, yi):
+    # Per sub-image pre-processing as done by the analyzer before the strided tile view
+    subimg = None
+    for i, j in zip(*np.nonzero(on_focus)):
+        x = xi + (SUBIMAGE_WIDTH*j)
+        y = yi + (SUBIMAGE_HEIGHT*i)
+        subimg = img[y:y+SUBIMAGE_HEIGHT, x:x+SUBIMAGE_WIDTH]
+        subimg = subimg.astype(np.float32)
+        subimg = np.expand_dims(subimg, axis=0)
+        subimg = np.transpose(subimg, (0,3,1,2))
+        subimg = np.ascontiguousarray(subimg) # sess.run() makes a contiguous copy anyway
+    return subimg
+
+
+def strided_tiles(img, on_focus, xi, yi, batch_size, buffer):
+    # Same steps as engine.compute_sample()
+    n_ysteps, n_xsteps = on_focus.shape
+    tiles = tile_view(img, xi, yi, n_xsteps, n_ysteps)
+
+    focus_i, focus_j = np.nonzero(on_focus)
+    for b in range(0, len(focus_i), batch_size):
+        batch = get_batch_buffer(buffer, len(focus_i[b:b+batch_size]))
+        for k, (i, j) in enumerate(zip(focus_i[b:b+batch_size], focus_j[b:b+batch_size])):
+            np.copyto(batch[k], tiles[i, j].transpose(2, 0, 1), casting="unsafe")
+    return buffer
+
+
+def measure(name, func, repeat):
+    func() # Warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<28} {min(times)*1000:10.2f} ms {peak/2**20:12.2f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sub-image extraction micro-benchmark")
+    parser.add_argument("--height", metavar="<PX>", default=4000, type=int, required=False,
+                        help="Synthetic sample image height")
+    parser.add_argument("--width", metavar="<PX>", default=6000, type=int, required=False,
+                        help="Synthetic sample image width")
+    parser.add_argument("--coverage", metavar="<RATIO>", default=0.6, type=float, required=False,
+                        help="Ratio of in-focus sub-images")
+    parser.add_argument("-b", "--batch", metavar="<BATCH_SIZE>", default=32, type=int, required=False,
+                        help="Sub-images per inference batch")
+    parser.add_argument("-r", "--repeat", metavar="<N>", default=5, type=int, required=False,
+                        help="Number of timed repetitions")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    n_ysteps = args.height // SUBIMAGE_HEIGHT
+    n_xsteps = args.width // SUBIMAGE_WIDTH
+    xi = (args.width % SUBIMAGE_WIDTH) // 2
+    yi = (args.height % SUBIMAGE_HEIGHT) // 2
+    on_focus = rng.random((n_ysteps, n_xsteps)) < args.coverage
+
+    buffer = [None]
+
+    print(f"Image {args.width}x{args.height}, {np.count_nonzero(on_focus)}/{on_focus.size} sub-images in focus")
+    print(f"{'Method':<28} {'Time (best)':>13} {'Peak traced':>15}")
+    measure("Per sub-image (legacy)", lambda: legacy_tiles(img, on_focus, xi, yi), args.repeat)
+    measure("Strided view + buffer", lambda: strided_tiles(img, on_focus, xi, yi, args.batch, buffer), args.repeat)
@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from engine import get_expdata, iter_samples, read_image, sample_focus
+from masking import MASKING_BACKENDS
+
+
+def timed_focus(img, mask_opts):
+    start = time.perf_counter()
+    focus = sample_focus(img, mask_opts)
+    return focus, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the sub-images selected with a downscaled leaf mask "
+                                                 "against the full resolution mask")
+    parser.add_argument("expdir", metavar="<EXP_DIR>", help="Path to the Blackbird experiment folder")
+    parser.add_argument("-s", "--scale", metavar="<SCALE>", default=0.5, type=float, required=False,
+                        help="Leaf mask scale to validate")
+    parser.add_argument("--masking", choices=MASKING_BACKENDS, default="auto", required=False,
+                        help="Leaf masking implementation")
+    parser.add_argument("-n", "--max-images", metavar="<N>", default=0, type=int, required=False,
+                        help="Max. number of images checked (0 = all)")
+    args = parser.parse_args()
+
+    expdata = get_expdata(args.expdir)
+    if expdata is None:
+        exit()
+
+    full_opts = {"backend": args.masking, "scale": 1.0}
+    scaled_opts = {"backend": args.masking, "scale": args.scale}
+
+    n_images = 0
+    n_tiles = 0
+    n_lost = 0      # In focus at full resolution only
+    n_added = 0     # In focus with the downscaled mask only
+    n_sample_diff = 0
+    t_full = 0
+    t_scaled = 0
+    for date, tray, _, sample in iter_samples(expdata):
+        if args.max_images > 0 and n_images >= args.max_images:
+            break
+        img_path = Path(expdata["path"]) / date / tray / sample
+        img = read_image(img_path)
+        if img is None:
+            continue
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        n_images += 1
+
+        full, t = timed_focus(img, full_opts)
+        t_full += t
+        scaled, t = timed_focus(img, scaled_opts)
+        t_scaled += t
+
+        if full is None or scaled is None:
+            if (full is None) != (scaled is None):
+                n_sample_diff += 1
+                print(f"{date}/{tray}/{sample}: sample found at full resolution {full is not None}, "
+                      f"downscaled {scaled is not None}")
+            continue
+
+        lost = np.count_nonzero(full[0] & ~scaled[0])
+        added = np.count_nonzero(~full[0] & scaled[0])
+        n_tiles += full[0].size
+        n_lost += lost
+        n_added += added
+        if lost or added:
+            print(f"{date}/{tray}/{sample}: {lost} sub-images not selected, {added} extra sub-images selected")
+
+    n_diff = n_lost + n_added
+    print(f"\n{n_images} images, {n_tiles} sub-images, mask scale {args.scale}")
+    print(f"Sub-image decisions differing from full resolution: {n_diff} ({n_diff/max(n_tiles, 1)*100:.2f}%), "
+          f"{n_lost} not selected, {n_added} extra")
+    print(f"Images with a different sample detection: {n_sample_diff}")
+    print(f"Masking time: full resolution {t_full:.2f} s, downscaled {t_scaled:.2f} s "
+          f"({t_full/max(t_scaled, 1e-9):.1f}x faster)")
@@ -0,0 +1,87 @@
+import os
+import sys
+import math
+import argparse
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+
+def synthetic_sample(height, width, coverage=0.45, seed=0):
+    """
+        RGB leaf disc sample: smooth green ellipse covering 'coverage' of the image, with a few
+        textured lesions, over a textured background (what the leaf masking tells apart)
+    """
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    if coverage <= 0:
+        return img
+    r = math.sqrt(min(coverage, 0.75) / math.pi) # Semi-axes as a fraction of each side
+    yy, xx = np.mgrid[:height, :width]
+    leaf = ((yy - height/2) / (height*r))**2 + ((xx - width/2) / (width*r))**2 < 1
+    img[leaf] = np.clip(np.array([40, 140, 50]) + rng.normal(0, 3, (np.count_nonzero(leaf), 3)), 0, 255)
+    for _ in range(5):
+        cy = rng.integers(int(height*(0.5-r/2)), int(height*(0.5+r/2)) + 1)
+        cx = rng.integers(int(width*(0.5-r/2)), int(width*(0.5+r/2)) + 1)
+        spot = (yy - cy)**2 + (xx - cx)**2 < (min(height, width) * 0.03)**2
+        img[spot] = rng.integers(0, 256, (np.count_nonzero(spot), 3), dtype=np.uint8)
+    return img
+
+
+def make_experiment(out_dir, n_dates=2, n_trays=2, n_samples=8, height=2448, width=3264, coverage=0.45,
+                    empty=0.0, seed=0):
+    """
+        Writes a synthetic experiment folder (<MM-DD-YYYY>_synthetic/tray<N>/<NNN>-S<N>.png) and returns
+        the number of images. A fraction 'empty' of the samples have no leaf (no sample found).
+    """
+    rng = np.random.default_rng(seed)
+    first = date(2025, 1, 6)
+    n_images = 0
+    for d in range(n_dates):
+        date_dir = Path(out_dir) / ((first + timedelta(days=d)).strftime('%m-%d-%Y') + "_synthetic")
+        for t in range(n_trays):
+            tray_dir = date_dir / f"tray{t+1}"
+            os.makedirs(tray_dir, exist_ok=True)
+            for s in range(n_samples):
+                sample_cov = 0 if rng.random() < empty else coverage
+                img = synthetic_sample(height, width, sample_cov, seed=int(rng.integers(2**31)))
+                # NOTE: cv2.imwrite() does not take non-ASCII paths in Windows
+                _, data = cv2.imencode(".png", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+                with open(tray_dir / f"{s+1:03d}-S{s+1}.png", "wb") as f:
+                    f.write(data.tobytes())
+                n_images += 1
+                print(f" ** {n_images}/{n_dates*n_trays*n_samples} images written.", end='\r')
+    print()
+    return n_images
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic Blackbird experiment folder generator")
+    parser.add_argument("out_dir", metavar="<OUT_DIR>", help="Experiment folder to create")
+    parser.add_argument("-d", "--dates", metavar="<N>", default=2, type=int, required=False,
+                        help="Number of timepoint folders")
+    parser.add_argument("-t", "--trays", metavar="<N>", default=2, type=int, required=False,
+                        help="Number of trays per timepoint")
+    parser.add_argument("-n", "--samples", metavar="<N>", default=8, type=int, required=False,
+                        help="Number of samples per tray")
+    parser.add_argument("--height", metavar="<PX>", default=2448, type=int, required=False,
+                        help="Image height")
+    parser.add_argument("--width", metavar="<PX>", default=3264, type=int, required=False,
+                        help="Image width")
+    parser.add_argument("-c", "--coverage", metavar="<RATIO>", default=0.45, type=float, required=False,
+                        help="Fraction of the image covered by the leaf disc (max. 0.75)")
+    parser.add_argument("--empty", metavar="<RATIO>", default=0.0, type=float, required=False,
+                        help="Fraction of samples without leaf")
+    parser.add_argument("-s", "--seed", metavar="<SEED>", default=0, type=int, required=False,
+                        help="Random seed")
+    args = parser.parse_args()
+
+    if os.path.exists(args.out_dir) and any(os.scandir(args.out_dir)):
+        print(f"Output folder '{args.out_dir}' is not empty!")
+        sys.exit(1)
+
+    n = make_experiment(args.out_dir, args.dates, args.trays, args.samples, args.height, args.width,
+                        args.coverage, args.empty, args.seed)
+    print(f"{n} images written to: {os.path.abspath(args.out_dir)}")
@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import engine
+from engine import BATCH_SIZE, prepare_sample, score_sample_models, load_model, open_result_cache
+from result_cache import NO_SAMPLE
+from make_experiment import synthetic_sample
+from bench_pipeline import synthetic_model
+
+# Sample images of the same contents saved as 3-channel (BGR) and 4-channel (BGRA) PNG files
+HEIGHT = 1000
+WIDTH = 1400
+
+
+def write_samples(out_dir):
+    bgr = cv2.cvtColor(synthetic_sample(HEIGHT, WIDTH, seed=1), cv2.COLOR_RGB2BGR)
+    bgra = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA)
+    paths = {"bgr": os.path.join(out_dir, "001-S1.png"), "bgra": os.path.join(out_dir, "002-S2.png")}
+    cv2.imwrite(paths["bgr"], bgr)
+    cv2.imwrite(paths["bgra"], bgra)
+    assert cv2.imread(paths["bgra"], cv2.IMREAD_UNCHANGED).shape == (HEIGHT, WIDTH, 4)
+    return paths
+
+
+def test_bgra_png_prepared_as_rgb():
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_samples(tmp)
+        mask_opts = {"backend": "numpy"}
+        rgb = prepare_sample(paths["bgr"], mask_opts=mask_opts)
+        rgba = prepare_sample(paths["bgra"], mask_opts=mask_opts)
+        assert rgba["image"].shape == (HEIGHT, WIDTH, 3)
+        assert np.array_equal(rgba["image"], rgb["image"])
+        assert np.array_equal(rgba["focus"], rgb["focus"])
+        assert np.array_equal(rgb["image"], synthetic_sample(HEIGHT, WIDTH, seed=1))
+
+        # Images kept in BGR order (models taking BGR sub-images) drop the alpha channel too
+        bgr = prepare_sample(paths["bgra"], mask_opts=dict(mask_opts, channels="BGR"))
+        assert np.array_equal(bgr["image"], rgb["image"][..., ::-1])
+
+
+def test_bgra_png_scored():
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_samples(tmp)
+        model_path = os.path.join(tmp, "model.onnx")
+        synthetic_model(model_path)
+        models = [load_model(model_path, ["CPUExecutionProvider"], 0, BATCH_SIZE, {"cache_dir": None})]
+
+        mask_opts = {"backend": "numpy"}
+        scores = [score_sample_models(models, prepare_sample(paths[k], mask_opts=mask_opts), [None])[0]
+                  for k in ["bgr", "bgra"]]
+        assert np.count_nonzero(~np.isnan(scores[0])) > 0
+        assert np.array_equal(scores[0], scores[1], equal_nan=True)
+
+
+def test_no_sample_cached():
+    with tempfile.TemporaryDirectory() as tmp:
+        img_path = os.path.join(tmp, "001-S1.png")
+        cv2.imwrite(img_path, synthetic_sample(HEIGHT, WIDTH, coverage=0))
+        model_path = os.path.join(tmp, "model.onnx")
+        synthetic_model(model_path)
+        mask_opts = {"backend": "numpy"}
+        cache = open_result_cache(model_path, {"cache_dir": os.path.join(tmp, "cache")}, mask_opts)
+
+        assert prepare_sample(img_path, [cache], mask_opts) is None
+        assert cache.get(cache.key(engine.read_file(img_path))) is NO_SAMPLE
+
+        # Cached: the image is not decoded again
+        imdecode = engine.cv2.imdecode
+        engine.cv2.imdecode = None
+        try:
+            assert prepare_sample(img_path, [cache], mask_opts) is None
+        finally:
+            engine.cv2.imdecode = imdecode
+        cache.close()
+
+
+if __name__ == "__main__":
+    test_bgra_png_prepared_as_rgb()
+    test_bgra_png_scored()
+    test_no_sample_cached()
+    print("OK")
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from engine import sample_focus
+from make_experiment import synthetic_sample
+
+MIN_AGREEMENT = 0.98        # Min. ratio of sub-image decisions equal to the full resolution mask ones
+SIZES = [(2448, 3264), (1000, 1400)]
+SCALES = [0.5, 0.25]
+N_SAMPLES = 3
+
+
+def test_mask_scale_agreement():
+    for height, width in SIZES:
+        for seed in range(N_SAMPLES):
+            img = synthetic_sample(height, width, seed=seed)
+            full = sample_focus(img, {"backend": "numpy", "scale": 1.0})
+            assert full is not None
+            for scale in SCALES:
+                scaled = sample_focus(img, {"backend": "numpy", "scale": scale})
+                # A sample found at full resolution is never lost at reduced resolution
+                assert scaled is not None, (height, width, seed, scale)
+                assert scaled[1:] == full[1:]
+                agreement = np.count_nonzero(scaled[0] == full[0]) / full[0].size
+                assert agreement >= MIN_AGREEMENT, (height, width, seed, scale, agreement)
+
+
+def test_mask_scale_no_sample():
+    img = synthetic_sample(1000, 1400, coverage=0)
+    for scale in [1.0] + SCALES:
+        assert sample_focus(img, {"backend": "numpy", "scale": scale}) is None
+
+
+if __name__ == "__main__":
+    test_mask_scale_agreement()
+    test_mask_scale_no_sample()
+    print("OK")
@@ -9,28 +9,295 @@ __status__ = "Production"
 
 from pathlib import Path
 import os
+import time
 import argparse
+import csv
 
 import openpyxl
 from openpyxl.utils import get_column_letter
-from openpyxl.styles import PatternFill, Alignment, Font, Border, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle, PatternFill, Alignment, Font, Border, Side, DEFAULT_FONT
+from openpyxl.styles.borders import DEFAULT_BORDER
 import numpy as np
-import msgpack
-import msgpack_numpy as mnp
-mnp.patch()
+
+from results_io import RESULTS_STORE_EXT, open_results
 
 
 # Useful colored strings
 hwarning = "\033[93m[WARNING]\033[0m: "
 herror = "\033[91m[ERROR]\033[0m: "
 
+SWEEP_FILENAME = "sweep.npz"
+EXPORT_FORMATS = [".csv", ".parquet"]
+
+
+def parse_range(arg):
+    # "START:STOP:N" -> N evenly spaced thresholds (START and STOP included), "TH" -> [TH]
+    parts = arg.split(":")
+    if len(parts) == 1:
+        return np.array([float(parts[0])])
+    if len(parts) != 3:
+        raise ValueError(f"Invalid threshold range '{arg}'")
+    return np.linspace(float(parts[0]), float(parts[1]), int(parts[2]))
+
+
+def sweep_counts(score_maps, lows, highs):
+    """
+        INF, CLR and ALL counts of every score map for every low and high threshold. INF only depends
+        on the high threshold and CLR on the low one, so all counts come from a single sort of the
+        scores of all the samples and a binary search per sample and threshold.
+        Returns (all[n_samples], inf[n_samples, n_highs], clr[n_samples, n_lows]).
+    """
+    scores = [s[~np.isnan(s)].astype(np.float32).ravel() for s in score_maps]
+    n_all = np.array([len(s) for s in scores], dtype=np.int64)
+    start = np.concatenate(([0], np.cumsum(n_all)[:-1]))
+
+    # NOTE: Offsetting each sample by 2*index keeps them apart in a single sorted array. The offset
+    # scores and thresholds are rounded to float64 (not exact): a score and a threshold closer than
+    # ~2e-16 * 2*index may compare equal, otherwise comparisons are the same as score >= threshold.
+    offsets = 2.0 * np.arange(len(scores))
+    keys = np.sort(np.concatenate([s.astype(np.float64) + o for s, o in zip(scores, offsets)] + [np.empty(0)]))
+
+    def n_below(th):
+        # Number of scores < th of each sample, for each threshold (cast to float32 like the scores)
+        th = th.astype(np.float32).astype(np.float64)
+        return np.searchsorted(keys, offsets[:, None] + th[None, :], side="left") - start[:, None]
+
+    return n_all, n_all[:, None] - n_below(highs), n_below(lows)
+
+
+def infection_percent(inf, clr, lows, highs):
+    # Infected % (INF / INF + CLR, truncated) of every sample and (low, high) pair, NaN if undefined
+    inf = inf[:, None, :].astype(np.float64)
+    clr = clr[:, :, None].astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percent = np.floor(inf / (inf + clr) * 100)
+    percent[:, lows[:, None] > highs[None, :]] = np.nan
+    return percent.astype(np.float32)
+
+
+def collect_samples(results):
+    # (date, tray, index, sample_id) keys and score maps of all the samples with a detected leaf
+    keys = []
+    score_maps = []
+    for d in results:
+        for t in results[d]:
+            for i, s in enumerate(results[d][t]):
+                if s is not None and s[1] is not None:
+                    keys.append((d, t, i, s[0]))
+                    score_maps.append(s[1])
+    return keys, score_maps
+
+
+def sweep(results, lows, highs, out_path):
+    """
+        Threshold sweep of all the samples with a score map. Saves a compressed table (.npz) with the
+        thresholds ("low", "high"), sample keys ("date", "tray", "slot", "sample_id") and results:
+        "all" (n_samples), "inf" (n_samples x n_highs), "clr" (n_samples x n_lows) and
+        "inf_percent" (n_samples x n_lows x n_highs, NaN if low > high or no sub-image is INF/CLR).
+    """
+    keys, score_maps = collect_samples(results)
+    n_all, inf, clr = sweep_counts(score_maps, lows, highs)
+    np.savez_compressed(out_path,
+                        low=lows,
+                        high=highs,
+                        date=np.array([k[0] for k in keys]),
+                        tray=np.array([k[1] for k in keys]),
+                        slot=np.array([k[2] for k in keys], dtype=np.int32),
+                        sample_id=np.array([k[3] for k in keys]),
+                        all=n_all,
+                        inf=inf,
+                        clr=clr,
+                        inf_percent=infection_percent(inf, clr, lows, highs))
+    return len(keys)
+
+
+def export_table(results, low, high, out_path):
+    """
+        Long-format table of the thresholded results, one row per sample: date, tray, sample_index,
+        sample_id, n_infected, n_clear, n_analyzed and inf_percent (empty/NaN if no sample was
+        detected or no sub-image is INF/CLR). Written as CSV or Parquet (pyarrow) depending on the
+        out_path extension.
+    """
+    ext = Path(out_path).suffix.lower()
+    if ext not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{ext}', use one of {', '.join(EXPORT_FORMATS)}")
+
+    columns = {name: [] for name in ("date", "tray", "sample_index", "sample_id", "n_infected", "n_clear",
+                                     "n_analyzed", "inf_percent")}
+    lows, highs = np.array([low]), np.array([high])
+    no_sample = np.empty(0, dtype=np.float32)
+    # NOTE: Counted one tray at a time, so memory use doesn't grow with the experiment
+    for d in results:
+        for t in results[d]:
+            samples = [(i, s) for i, s in enumerate(results[d][t]) if s is not None]
+            n_all, inf, clr = sweep_counts([s[1] if s[1] is not None else no_sample for _, s in samples], lows, highs)
+            columns["date"] += [d] * len(samples)
+            columns["tray"] += [t] * len(samples)
+            columns["sample_index"] += [i for i, _ in samples]
+            columns["sample_id"] += [s[0] for _, s in samples]
+            columns["n_infected"] += inf[:, 0].tolist()
+            columns["n_clear"] += clr[:, 0].tolist()
+            columns["n_analyzed"] += n_all.tolist()
+            columns["inf_percent"] += infection_percent(inf, clr, lows, highs)[:, 0, 0].tolist()
+
+    if ext == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Parquet export requires the pyarrow package (pip install pyarrow)")
+        inf_percent = np.array(columns["inf_percent"], dtype=np.float64)
+        columns["inf_percent"] = pa.array(inf_percent, mask=np.isnan(inf_percent))
+        pq.write_table(pa.table(columns), out_path)
+    else:
+        columns["inf_percent"] = ["" if np.isnan(p) else int(p) for p in columns["inf_percent"]]
+        with open(out_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns.keys())
+            writer.writerows(zip(*columns.values()))
+    return len(columns["date"])
+
+
+def xlsx_styles():
+    """
+        Named styles of the thresholder workbook, keyed by cell role. Cells get one of these shared
+        styles instead of their own font/fill/border/alignment objects.
+    """
+    thin_border = Side(border_style="thin", color="000000")
+    thick_border = Side(border_style="thick", color="000000")
+    header_color = PatternFill(fgColor="CCCCCC", fill_type="solid")
+    inf_color = PatternFill(fgColor="F5B7B1", fill_type="solid")
+    clr_color = PatternFill(fgColor="B0E0E6", fill_type="solid")
+
+    thin = Border(top=thin_border, left=thin_border, right=thin_border, bottom=thin_border)
+    tick_left = Border(top=thin_border, left=thick_border, right=thin_border, bottom=thin_border)
+    tick_right = Border(top=thin_border, left=thin_border, right=thick_border, bottom=thin_border)
+    center = Alignment(horizontal="center")
+    bold = Font(bold=True)
+
+    styles = {
+        "sample_header": dict(font=bold, fill=header_color, border=thin,
+                              alignment=Alignment(horizontal="center", vertical="center")),
+        # NOTE: Merged cells only keep the outer borders of the merged range
+        "sample_header_merged": dict(border=Border(left=thin_border, right=thin_border, bottom=thin_border)),
+        "date": dict(font=bold, fill=header_color, border=tick_left, alignment=center),
+        "date_merged": dict(border=Border(top=thin_border, bottom=thin_border)),
+        "date_merged_last": dict(border=Border(right=thin_border, top=thin_border, bottom=thin_border)),
+        "%": dict(font=bold, fill=inf_color, border=tick_left, alignment=center),
+        "INF": dict(font=bold, fill=inf_color, border=thin, alignment=center),
+        "CLR": dict(font=bold, fill=clr_color, border=thin, alignment=center),
+        "ALL": dict(font=bold, fill=header_color, border=tick_right, alignment=center),
+    }
+    # Sample rows: first (%), middle (INF, CLR) and last (ALL) columns of each date
+    for col, border in (("first", tick_left), ("middle", thin), ("last", tick_right)):
+        styles["empty_" + col] = dict(border=border)
+        styles["value_" + col] = dict(border=border, alignment=center)
+        styles["missing_" + col] = dict(border=border, fill=inf_color, alignment=center)
+    # NOTE: Same default font and border as plain cells (NamedStyle defaults are empty ones)
+    return {key: NamedStyle(name="Blackbird " + key, **{"font": DEFAULT_FONT, "border": DEFAULT_BORDER, **style})
+            for key, style in styles.items()}
+
+
+def tray_stats(tray, low, high):
+    # (sample_id, [%, INF, CLR, ALL], no sample detected) of each slot of a tray, None if empty
+    stats = []
+    for s in tray:
+        if s is None:
+            stats.append(None)
+        elif s[1] is not None:
+            n_analyzed_subim = np.count_nonzero(~np.isnan(s[1]))
+            n_infected = np.count_nonzero(s[1] >= high)
+            n_clear = np.count_nonzero(s[1] < low)
+            inf_percent = int(n_infected / (n_infected+n_clear) * 100)
+            stats.append((s[0], [inf_percent, n_infected, n_clear, n_analyzed_subim], False))
+        else: # No sample detected
+            stats.append((s[0], [0, 0, 0, 0], True))
+    return stats
+
+
+def write_xlsx(results, low, high, out_path):
+    """
+        Writes the thresholded results as an Excel file, one sheet per tray with the %, INF, CLR and
+        ALL columns of every date. Sheets are streamed row by row (openpyxl write-only mode), so
+        only the counts of the tray being written are kept in memory.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    styles = xlsx_styles()
+    for style in styles.values():
+        wb.add_named_style(style)
+
+    def cell(ws, value, style):
+        c = WriteOnlyCell(ws, value)
+        if style is not None:
+            c.style = styles[style].name
+        return c
+
+    # Unique tray IDs (all trays have the same date columns even if some timepoints don't have them)
+    dates_ids = list(results.keys())
+    trays = []
+    for d in dates_ids:
+        for t in results[d]:
+            if t not in trays:
+                trays.append(t)
+
+    n_processed = 0
+    roles = ["first", "middle", "middle", "last"]
+    for t in trays:
+        ws = wb.create_sheet(t)
+        ws.column_dimensions["A"].width = 30
+        for j in range(len(dates_ids)):
+            for k in range(4):
+                ws.column_dimensions[get_column_letter((j*4)+2+k)].width = 5
+        ws.freeze_panes = get_column_letter((len(dates_ids)*4)+2) + "3"
+
+        # Counts of this tray for every date
+        columns = []
+        sample_ids = {}
+        for d in dates_ids:
+            stats = tray_stats(results[d][t], low, high) if t in results[d] else []
+            for i, st in enumerate(stats):
+                if st is not None:
+                    sample_ids[i] = st[0] # Sample ID of the last date
+                    n_processed += 1
+                    print(f" ** {n_processed} samples processed.", end='\r')
+            columns.append(stats)
+
+        # Headers
+        ws.merged_cells.add("A1:A2")
+        row1 = [cell(ws, "SampleID", "sample_header")]
+        row2 = [cell(ws, None, "sample_header_merged")]
+        for j, d in enumerate(dates_ids):
+            ws.merged_cells.add(get_column_letter((j*4)+2) + "1:" + get_column_letter((j*4)+5) + "1")
+            row1 += [cell(ws, d, "date"), cell(ws, None, "date_merged"), cell(ws, None, "date_merged"),
+                     cell(ws, None, "date_merged_last")]
+            row2 += [cell(ws, header, header) for header in ("%", "INF", "CLR", "ALL")]
+        ws.append(row1)
+        ws.append(row2)
+
+        # Sample rows (as many as sample slots in the tray, 351 for the standard trays)
+        n_rows = max(len(stats) for stats in columns)
+        for i in range(n_rows):
+            row = [cell(ws, sample_ids.get(i, "N/A"), "empty_middle")]
+            for stats in columns:
+                st = stats[i] if i < len(stats) else None
+                if st is None:
+                    row += [cell(ws, None, "empty_" + role) for role in roles]
+                else:
+                    kind = "missing" if st[2] else "value"
+                    row += [cell(ws, value, kind + "_" + role) for value, role in zip(st[1], roles)]
+            ws.append(row)
+
+    print("\n ** Done")
+    wb.save(out_path)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Blackbird Results Thresholder")
     parser.add_argument(
         "res_path",
         metavar="<RES_PATH>",
-        help="Path to experiment results as a *.msgpack file.",
+        help="Path to experiment results as a *.msgpack file (or a *" + RESULTS_STORE_EXT + " results store, read one tray at a time).",
     )
     parser.add_argument(
         "-o",
@@ -58,6 +325,35 @@ if __name__ == "__main__":
         type=float,
         required=False,
     )
+    parser.add_argument(
+        "--sweep-low",
+        help="Sweep mode: low thresholds as START:STOP:N (N values, START and STOP included)",
+        metavar="<START:STOP:N>",
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--sweep-high",
+        help="Sweep mode: high thresholds as START:STOP:N (N values, START and STOP included)",
+        metavar="<START:STOP:N>",
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--sweep-out",
+        metavar="<OUT_NPZ>",
+        required=False,
+        default=SWEEP_FILENAME,
+        help="Path of the sweep mode results table (.npz)",
+    )
+    parser.add_argument(
+        "-e",
+        "--export",
+        metavar="<OUT_TABLE>",
+        required=False,
+        default=None,
+        help="Export mode: path of a long-format table of the results (.csv or .parquet) written instead of the Excel file",
+    )
     args = parser.parse_args()
 
     if not os.path.exists(args.res_path):
@@ -70,142 +366,36 @@ if __name__ == "__main__":
 
     res_path = Path(args.res_path)
 
-    # Read msgpack file
-    with open(res_path, "rb") as data_file:
-        byte_data = data_file.read()
-        results = msgpack.unpackb(byte_data)
+    # Read msgpack file (results stores are read lazily)
+    results = open_results(res_path)
+
+    if args.sweep_low is not None or args.sweep_high is not None:
+        try:
+            lows = parse_range(args.sweep_low if args.sweep_low is not None else str(args.low))
+            highs = parse_range(args.sweep_high if args.sweep_high is not None else str(args.high))
+        except ValueError as e:
+            print(herror + " " + str(e) + "!")
+            exit()
+
+        print(f" ** Sweeping {len(lows)} low x {len(highs)} high thresholds...")
+        start = time.time()
+        n_samples = sweep(results, lows, highs, args.sweep_out)
+        print(f" ** Done, {n_samples} samples in {time.time()-start:.2f} s")
+        print("Sweep table saved to:", os.path.abspath(args.sweep_out))
+        exit()
 
+    if args.export is not None:
+        print(f" ** Exporting results... Low_th: {args.low}, High_th: {args.high}")
+        start = time.time()
+        try:
+            n_samples = export_table(results, args.low, args.high, args.export)
+        except (ValueError, ImportError) as e:
+            print(herror + " " + str(e) + "!")
+            exit()
+        print(f" ** Done, {n_samples} samples in {time.time()-start:.2f} s")
+        print("Results table saved to:", os.path.abspath(args.export))
+        exit()
 
     print(f" ** Thresholding results... Low_th: {args.low}, High_th: {args.high}")
-
-    # Create Excel sheet
-    wb = openpyxl.Workbook()
-
-    # Get unique tray IDs
-    trays_sheets = {}
-    for d in results:
-        for t in results[d]:
-            if t not in trays_sheets:
-                trays_sheets[t] = wb.create_sheet(t)
-
-    dates_ids = results.keys()
-
-    # Delete default sheet
-    del wb['Sheet']
-
-    #print(trays_sheets)
-    thin_border = Side(border_style="thin", color="000000")
-    thick_border = Side(border_style="thick", color="000000")
-    header_color = PatternFill(fgColor="CCCCCC", fill_type = "solid")
-
-    inf_color = PatternFill(fgColor="F5B7B1", fill_type = "solid")
-    clr_color = PatternFill(fgColor="B0E0E6", fill_type = "solid")
-
-    tick_left = Border(top=thin_border, left=thick_border, right=thin_border, bottom=thin_border)
-    tick_right = Border(top=thin_border, left=thin_border, right=thick_border, bottom=thin_border)
-    n_processed = 0
-
-    # Initialize row and column headers (dates & sampleIDs)
-    for t in trays_sheets.keys():
-
-        # Apply thin borders in all sheet
-        for row in trays_sheets[t]["A1:"+get_column_letter((len(dates_ids)*4)+1)+"353"]:
-            for cell in row:
-                cell.border = Border(top=thin_border, left=thin_border, right=thin_border, bottom=thin_border)
-
-        # Initialize sample ids with N/A
-        trays_sheets[t]["A1"] = "SampleID"
-        trays_sheets[t].column_dimensions["A"].width = 30
-        trays_sheets[t].merge_cells(start_row=1, start_column=1, end_row=2, end_column=1)
-        trays_sheets[t]["A1"].alignment = Alignment(horizontal='center',vertical="center")
-        trays_sheets[t]["A1"].font = Font(bold=True)
-        trays_sheets[t]["A1"].fill = header_color
-        
-
-        # Intialize all sampleIDs as N/A
-        for r in range(3,354):
-            trays_sheets[t].cell(row=r, column=1).value = "N/A"
-
-            # Apply thick borders separating dates
-            for j, d in enumerate(dates_ids):
-                trays_sheets[t].cell(row=r, column=(j*4)+2).border = tick_left
-                trays_sheets[t].cell(row=r, column=(j*4)+5).border = tick_right
-
-        # Initialize date headers (all trays same even if some timepoints don't have a specific tray)
-        for j, d in enumerate(dates_ids):
-            trays_sheets[t].cell(row=1, column=(j*4)+2).value = d
-            trays_sheets[t].cell(row=1, column=(j*4)+2).font = Font(bold=True)
-            trays_sheets[t].cell(row=1, column=(j*4)+2).fill = header_color
-            trays_sheets[t].merge_cells(start_row=1, start_column=(j*4)+2, end_row=1, end_column=(j*4)+5)
-            trays_sheets[t].cell(row=1, column=(j*4)+2).border =  tick_left
-            trays_sheets[t].cell(row=1, column=(j*4)+5).border =  tick_right
-
-            trays_sheets[t].column_dimensions[get_column_letter((j*4)+2)].width = 5
-            trays_sheets[t].column_dimensions[get_column_letter((j*4)+3)].width = 5
-            trays_sheets[t].column_dimensions[get_column_letter((j*4)+4)].width = 5
-            trays_sheets[t].column_dimensions[get_column_letter((j*4)+5)].width = 5
-            trays_sheets[t][get_column_letter((j*4)+2)+"1"].alignment = Alignment(horizontal='center')
-
-            trays_sheets[t].cell(row=2, column=(j*4)+2).value = "%"
-            trays_sheets[t].cell(row=2, column=(j*4)+2).alignment = Alignment(horizontal='center')
-            trays_sheets[t].cell(row=2, column=(j*4)+2).fill = inf_color
-            trays_sheets[t].cell(row=2, column=(j*4)+2).font = Font(bold=True)
-            trays_sheets[t].cell(row=2, column=(j*4)+2).border = tick_left
-
-            trays_sheets[t].cell(row=2, column=(j*4)+3).value = "INF"
-            trays_sheets[t].cell(row=2, column=(j*4)+3).alignment = Alignment(horizontal='center')
-            trays_sheets[t].cell(row=2, column=(j*4)+3).fill = inf_color
-            trays_sheets[t].cell(row=2, column=(j*4)+3).font = Font(bold=True)
-
-            trays_sheets[t].cell(row=2, column=(j*4)+4).value = "CLR"
-            trays_sheets[t].cell(row=2, column=(j*4)+4).alignment = Alignment(horizontal='center')
-            trays_sheets[t].cell(row=2, column=(j*4)+4).fill = clr_color
-            trays_sheets[t].cell(row=2, column=(j*4)+4).font = Font(bold=True)
-            
-            trays_sheets[t].cell(row=2, column=(j*4)+5).value = "ALL"
-            trays_sheets[t].cell(row=2, column=(j*4)+5).alignment = Alignment(horizontal='center')
-            trays_sheets[t].cell(row=2, column=(j*4)+5).fill = header_color
-            trays_sheets[t].cell(row=2, column=(j*4)+5).font = Font(bold=True)
-            trays_sheets[t].cell(row=2, column=(j*4)+5).border = tick_right
-
-            if t in results[d]:
-                for i, s in enumerate(results[d][t]):
-                    if s is not None:
-
-                        # NOTE: This cell assignment will be overwritten multiple times but it's OK
-                        trays_sheets[t].cell(row=i+3, column=1).value = s[0]
-
-                        # Compute sample results
-                        if s[1] is not None:
-                            n_analyzed_subim = np.count_nonzero(~np.isnan(s[1]))
-                            n_infected = np.count_nonzero(s[1] >= args.high)
-                            n_clear = np.count_nonzero(s[1] < args.low)
-                            inf_percent = int(n_infected / (n_infected+n_clear) * 100)
-                        else: # No sample detected
-                            n_analyzed_subim = 0
-                            n_infected = 0
-                            n_clear = 0
-                            inf_percent = 0
-                            trays_sheets[t].cell(row=i+3, column=(j*4)+2).fill = inf_color
-                            trays_sheets[t].cell(row=i+3, column=(j*4)+3).fill = inf_color
-                            trays_sheets[t].cell(row=i+3, column=(j*4)+4).fill = inf_color
-                            trays_sheets[t].cell(row=i+3, column=(j*4)+5).fill = inf_color
-
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+2).value = inf_percent
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+2).alignment = Alignment(horizontal='center')
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+3).value = n_infected
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+3).alignment = Alignment(horizontal='center')
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+4).value = n_clear
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+4).alignment = Alignment(horizontal='center')
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+5).value = n_analyzed_subim
-                        trays_sheets[t].cell(row=i+3, column=(j*4)+5).alignment = Alignment(horizontal='center')
-
-                        n_processed += 1
-                        print(f" ** {n_processed} samples processed.",end='\r')
-
-        trays_sheets[t].freeze_panes = trays_sheets[t].cell(row=3, column=(len(dates_ids)*4)+2)
-
-    print("\n ** Done")
-
-    wb.save(args.out)
+    write_xlsx(results, args.low, args.high, args.out)
     print("Resulting Excel file saved to:", os.path.abspath(args.out))